@@ -0,0 +1 @@
+# lets the tests import the app's utils package from the repository root
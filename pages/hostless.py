@@ -1,15 +1,16 @@
 import streamlit as st
 import astropy
-from astropy.io import fits
 import numpy as np
-import gzip
-import io
-from io import BytesIO
 import pandas as pd
-from sqlalchemy import create_engine, text, insert, MetaData
-from astropy.stats import sigma_clipped_stats as scs
-import matplotlib.pyplot as plt
+from utils.db import get_engine
+from utils.write_queue import default_queue, pending_indicator
+from utils.classified_index import default_index
 from streamlit_float import *
+from utils.cutouts import load_candids
+from utils.hostless import hostless_params, default_cache
+from utils.render import render_triplet
+from utils.prefetch import Prefetcher
+from utils.queries import run_query
 
 
 st.set_page_config(page_title="Hostless", page_icon="🌌", layout = "wide")
@@ -51,254 +52,82 @@ with st.form("my_form"):
         candlim = st.text_input("Candidate limit", value = 100, key = "candlim")
     st.form_submit_button()
 
-@st.cache_resource
-def init_connection():
-    db_user = st.secrets.wise_db.username
-    db_password = st.secrets.wise_db.password
-    db_host = st.secrets.wise_db.host
-    db_port = st.secrets.wise_db.port
-    db_name = st.secrets.wise_db.database
-
-    # Create SQLAlchemy engine
-    engine = create_engine(f'postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}')
-
-    return engine
-
-engine = init_connection()
-metadata = MetaData()
-metadata.reflect(bind=engine)
-
-@st.cache_data
-def get_count(candids):
-    count = len(candids)
-    return count
-
-@st.cache_data
-def get_ra_dec(candid):
-    df = pd.read_sql_query(f"""
-        SELECT ra, dec from candidates WHERE candid = {candid};""", engine)
-    ra = df.ra[0]
-    dec = df.dec[0]
-    return ra, dec
-
-@st.cache_data
-def hostless_candids(scanep, gallimlow, gallimhigh, candlim):
-    
-    scanep = int(scanep)
-    rbscorelow = 0.5
-    rbscorehigh = 1.0
-    nmatches = 2
-    scorrpeak = 10
-    gallimlow = float(gallimlow)
-    gallimhigh = float(gallimhigh)
-    agelowlim = 10.0
-    agehighlim = 400.0
-    hlwdist = 3 # closest WISE source distance
-    brmaglim = 7.0 # reject if WISE source is brighter than this
-    brdistlim = 10 # within this many arcseconds
-    candlim = int(candlim)
-    
-    query = f"SELECT candid FROM candidates cand INNER JOIN fields f on f.field = cand.field WHERE abs(f.gallat) >= {gallimlow:.2f} and abs(f.gallat) < {gallimhigh:.2f} AND epochid = {scanep} AND rbscore >= {rbscorelow} AND rbscore <= {rbscorehigh} AND nmatches >= {nmatches} AND scorr_peak >= {scorrpeak} AND ispos = 1 AND mjd - firstdet > {agelowlim} AND mjd - firstdet < {agehighlim} AND wdist1 > {hlwdist} AND wdist2 > {hlwdist} AND wdist3 > {hlwdist} AND distnearbrstar > {brdistlim} AND (wdist1 > {brdistlim} OR w1mag1 > {brmaglim}) AND (wdist2 > {brdistlim} OR w1mag2 > {brmaglim}) AND (wdist3 > {brdistlim} OR w1mag3 > {brmaglim}) ORDER BY rbscore DESC OFFSET 0 LIMIT {candlim};"
-    
-    with engine.connect() as con:
-        try:
-            st.toast(f"Executing query...")
-            result = con.execute(text(query))
-            candids = [i for candid in result.fetchall() for i in candid]
-            st.toast(f"Found {len(candids)} candidates.")
-        except:
-            st.toast(f"Could not get candidates.")
-            st.stop()
-
-    return candids
+engine = get_engine()
+write_queue = default_queue(engine)
+classified = default_index(engine)
+scan_cache = default_cache(engine)
+with st.sidebar:
+    pending_indicator(write_queue)
+
+params = hostless_params(scanep, gallimlow, gallimhigh)
+candlim = int(candlim)
+
+def hostless_candids(params, candlim):
+    # shared by every session running the same search, see utils.hostless.ScanCache
+    try:
+        return scan_cache.load(engine, params, candlim,
+                               run = lambda scan: run_query(engine, "Scanning hostless candidates", scan, key = "hostless_scan"))
+    except Exception:
+        st.toast(f"Could not get candidates.")
+        st.stop()
 
 def get_images_from_db(_candids):
-    
-    if len(_candids) > 1:
-        _candids = tuple(_candids)
-    else:
-        _candids = f"('{_candids[0]}')"
-    
-    images = pd.read_sql_query(f"""
-        SELECT c.candid, c.sci_image, c.ref_image, c.diff_image from cutouts c INNER JOIN (SELECT DISTINCT(candid) from candidates) s ON c.candid = s.candid WHERE c.candid IN {_candids};""", engine)
-    
-    sci_images = []
-    ref_images = []
-    diff_images = []
-    candids = []
-    
-    params_dict = {"sci_vmin": [], "sci_vmax": [], "ref_vmin": [], "ref_vmax": [], "diff_vmin": [], "diff_vmax": []}
-    
-    for i in range(len(images)):
-        sci_image_b = images.sci_image[i]
-        ref_image_b = images.ref_image[i]
-        diff_image_b = images.diff_image[i]
-        candids.append(images.candid[i])
-        
-        sci_cutout = np.flipud(fits.open(BytesIO(gzip.open(io.BytesIO(sci_image_b), 'rb').read()))[0].data)
-        ref_cutout = np.flipud(fits.open(BytesIO(gzip.open(io.BytesIO(ref_image_b), 'rb').read()))[0].data)
-        diff_cutout = np.flipud(fits.open(BytesIO(gzip.open(io.BytesIO(diff_image_b), 'rb').read()))[0].data)
-        sci_images.append(sci_cutout)
-        ref_images.append(ref_cutout)
-        diff_images.append(diff_cutout)
-    
-        sci_mean, sci_median, sci_std = scs(sci_cutout)
-        ref_mean, ref_median, ref_std = scs(ref_cutout)
-        diff_mean, diff_median, diff_std = scs(diff_cutout)
-        
-        lowp = 1
-        highp = 5
-        vmin = sci_median - lowp * sci_std
-        vmax = sci_median + highp * sci_std
-        params_dict["sci_vmin"].append(vmin)
-        params_dict["sci_vmax"].append(vmax)
-        vmin = ref_median - lowp * ref_std
-        vmax = ref_median + highp * ref_std
-        params_dict["ref_vmin"].append(vmin)
-        params_dict["ref_vmax"].append(vmax)
-        vmin = diff_median - lowp * diff_std
-        vmax = diff_median + highp * diff_std
-        params_dict["diff_vmin"].append(vmin)
-        params_dict["diff_vmax"].append(vmax)
-
-    return candids, sci_images, ref_images, diff_images, params_dict
-
-@st.cache_data
-def plot_triplet(i, candid, sci, ref, diff):
-    fig, ax = plt.subplots(1, 3, figsize = (10, 3))
-    ax = ax.flatten()
-
-    ax[0].imshow(sci, cmap='gray', interpolation = 'nearest', aspect = 'equal', vmin = params["sci_vmin"][i], vmax = params["sci_vmax"][i])
-    ax[1].imshow(ref, cmap='gray', interpolation = 'nearest', aspect = 'equal', vmin = params["ref_vmin"][i], vmax = params["ref_vmax"][i])
-    ax[2].imshow(diff, cmap='gray', interpolation = 'nearest', aspect = 'equal', vmin = params["diff_vmin"][i], vmax = params["diff_vmax"][i])
-    # Add a title and axis labels (optional)
-    fig.suptitle(f'cand: {candid}', x = 0.5, y = 1.05, fontsize = 16)
-    ax[0].set_title('sci', fontsize = 12)
-    ax[1].set_title('ref', fontsize = 12)
-    ax[2].set_title('diff', fontsize = 12)
-    
-    for a in ax:
-        a.axis('off')
-    plt.subplots_adjust(left=None, bottom=None, right=None, top=None, wspace=None, hspace=None)
-    
-    return fig
+    return load_candids(engine, _candids)
 
 
 def insert_candidate(_engine, source, candid):
-    
-    max_id = get_id(_engine, source)
-    correct_col = f"{source}id"
-    data = ({correct_col: max_id+1, "candid": str(candid)})
     if st.session_state.username == "visitor":
         st.toast(f"Classified {candid} as {source}.")
-    else:    
-        if candid in all_classified(_engine):
-            st.toast(f"Candidate {candid} is already classified.")
-        else:
-            with _engine.connect() as con:
-                try:
-                    table = metadata.tables.get(source)
-                    query = insert(table).values(**data) #INSERT INTO reals (realsid, candid) VALUES (%(realsid)s, %(candid)s)
-                    # st.toast(str(query.compile(engine, compile_kwargs={"literal_binds": True})))
-                    con.execute(query)
-                    con.commit()
-                    # st.toast(f"Classified {candid} as {source}.")
-                    st.toast(f"Classified {candid} as {source}.")
-                except:
-                    st.toast(f"Could not insert candidate {candid} into {source}.")
-                    st.stop()
-
-def get_id(engine, source):
-    with engine.connect() as con:
-        try:
-            query = f"SELECT MAX({source}id) FROM {source}"
-            result = con.execute(text(query))
-            id = result.fetchone()[0]
-        except:
-            st.toast(f"Could not get ID for {source}.")
-            st.stop()
-    return(id)
+    elif candid in classified or write_queue.queued([candid]):
+        st.toast(f"Candidate {candid} is already classified.")
+    else:
+        # saved in the background; a label written by someone else in the meantime is kept.
+        # the cached scan is left alone, it is dropped once the classified index sees the write
+        write_queue.classify(candid, source, replace = False)
+        st.toast(f"Classified {candid} as {source}.")
 
 @st.fragment    
 def artifact_button(i, candid):
     if st.button("Artifact", key = i):
         insert_candidate(engine, "artifact", candid)
-        st.rerun()
 
 @st.fragment
 def reals_button(i, candid):
     if st.button("Real", key = i+1e5):
         insert_candidate(engine, "reals", candid)
-        st.rerun()
 
 @st.fragment
 def echo_button(i, candid):
     if st.button("Echo", key = i+2e5):
         insert_candidate(engine, "echo", candid)
-        st.rerun()
 
 @st.fragment        
 def highpm_button(i, candid):
     if st.button("High PM", key = i+3e5):
         insert_candidate(engine, "highpm", candid)
-        st.rerun()
 
 def page_load(page):
-    if page == page_list[-1]: # if last page, then only load the remaining images
-        for i in range(img_ppage*(page-1), len(candids)):
-            st.header(f"{i}")
-            fig = plot_triplet(i, candids[i], sci[i], ref[i], diff[i])
-            st.pyplot(fig)
-            col1, col2, col3, col4, col5 = st.columns([0.2, 0.2, 0.2, 0.2, 0.2])
-            with col1:
-                artifact_button(i, candids[i])
-            with col2:
-                reals_button(i, candids[i])
-            with col3:
-                echo_button(i, candids[i])
-            with col4:
-                highpm_button(i, candids[i])
-            ra, dec = get_ra_dec(candids[i])
-            byworlds = f"http://byw.tools/wiseview#ra={ra}&dec={dec}&size=176&band=2&speed=234.62&minbright=-2.3497&maxbright=963.1413&window=0.09958&diff_window=1&linear=1&color=&zoom=10&border=0&gaia=0&invert=0&maxdyr=0&scandir=0&neowise=0&diff=0&outer_epochs=0&unique_window=1&smooth_scan=0&shift=0&pmra=0&pmdec=0&synth_a=0&synth_a_sub=0&synth_a_ra=&synth_a_dec=&synth_a_w1=&synth_a_w2=&synth_a_pmra=0&synth_a_pmdec=0&synth_a_mjd=&synth_b=0&synth_b_sub=0&synth_b_ra=&synth_b_dec=&synth_b_w1=&synth_b_w2=&synth_b_pmra=0&synth_b_pmdec=0&synth_b_mjd="
-            st.link_button("See in BYW", url = byworlds)
-    else: # load 100 images per page
-        for img in range(img_ppage*(page-1), img_ppage*page):
-            st.header(f"{img}")
-            fig = plot_triplet(img, candids[img], sci[img], ref[img], diff[img])
-            st.pyplot(fig)
-            col1, col2, col3, col4, col5 = st.columns([0.2, 0.2, 0.2, 0.2, 0.2])
-            with col1:
-                artifact_button(img, candids[img])
-            with col2:
-                reals_button(img, candids[img])
-            with col3:
-                echo_button(img, candids[img])
-            with col4:
-                highpm_button(img, candids[img])
-            ra, dec = get_ra_dec(candids[img])
-            byworlds = f"http://byw.tools/wiseview#ra={ra}&dec={dec}&size=176&band=2&speed=234.62&minbright=-2.3497&maxbright=963.1413&window=0.09958&diff_window=1&linear=1&color=&zoom=10&border=0&gaia=0&invert=0&maxdyr=0&scandir=0&neowise=0&diff=0&outer_epochs=0&unique_window=1&smooth_scan=0&shift=0&pmra=0&pmdec=0&synth_a=0&synth_a_sub=0&synth_a_ra=&synth_a_dec=&synth_a_w1=&synth_a_w2=&synth_a_pmra=0&synth_a_pmdec=0&synth_a_mjd=&synth_b=0&synth_b_sub=0&synth_b_ra=&synth_b_dec=&synth_b_w1=&synth_b_w2=&synth_b_pmra=0&synth_b_pmdec=0&synth_b_mjd="
-            st.link_button("See in BYW", url = byworlds)
-
-def all_classified(_engine, save = False):
-    
-    all_reals = [item for sublist in pd.read_sql_query("SELECT candid FROM reals", _engine).values for item in sublist]
-    all_artifacts = [item for sublist in pd.read_sql_query("SELECT candid FROM artifact", _engine).values.tolist() for item in sublist]
-    all_echos = [item for sublist in pd.read_sql_query("SELECT candid FROM echo", _engine).values.tolist() for item in sublist]
-    all_highpms = [item for sublist in pd.read_sql_query("SELECT candid FROM highpm", _engine).values.tolist() for item in sublist]
-
-    if save:
-        np.savez_compressed("all_classified.npz", reals = all_reals, artifacts = all_artifacts, echos = all_echos, highpms = all_highpms)
-
-    return np.concatenate((all_reals, all_artifacts, all_echos, all_highpms), axis = 0)
-
-filtered_cands = hostless_candids(scanep, gallimlow, gallimhigh, candlim)
-all_class_cands = all_classified(engine)
-filtered_cands1 = np.setdiff1d(filtered_cands, all_class_cands)
+    start = img_ppage*(page-1)
+    for j in range(len(candids)): # only this page's cutouts are loaded
+        img = start + j
+        st.header(f"{img}")
+        render_triplet(candids[j], sci[j], ref[j], diff[j], vmin[j], vmax[j])
+        col1, col2, col3, col4, col5 = st.columns([0.2, 0.2, 0.2, 0.2, 0.2])
+        with col1:
+            artifact_button(img, candids[j])
+        with col2:
+            reals_button(img, candids[j])
+        with col3:
+            echo_button(img, candids[j])
+        with col4:
+            highpm_button(img, candids[j])
+        ra, dec = cutouts.ra[j], cutouts.dec[j]
+        byworlds = f"http://byw.tools/wiseview#ra={ra}&dec={dec}&size=176&band=2&speed=234.62&minbright=-2.3497&maxbright=963.1413&window=0.09958&diff_window=1&linear=1&color=&zoom=10&border=0&gaia=0&invert=0&maxdyr=0&scandir=0&neowise=0&diff=0&outer_epochs=0&unique_window=1&smooth_scan=0&shift=0&pmra=0&pmdec=0&synth_a=0&synth_a_sub=0&synth_a_ra=&synth_a_dec=&synth_a_w1=&synth_a_w2=&synth_a_pmra=0&synth_a_pmdec=0&synth_a_mjd=&synth_b=0&synth_b_sub=0&synth_b_ra=&synth_b_dec=&synth_b_w1=&synth_b_w2=&synth_b_pmra=0&synth_b_pmdec=0&synth_b_mjd="
+        st.link_button("See in BYW", url = byworlds)
 
 # np.savez_compressed("filtered_cands.npz", candid = filtered_cands1)
 
 
-candids, sci, ref, diff, params = get_images_from_db(filtered_cands1)
 # keys = ["incorrect"]
 
 # for key in keys:
@@ -316,7 +145,12 @@ candids, sci, ref, diff, params = get_images_from_db(filtered_cands1)
 #     st.session_state.scroll_to_top = True
     
 img_ppage = 50
-page_num = len(candids) // img_ppage
+filtered_cands = hostless_candids(params, candlim)
+# candidates classified on this server whose write hasn't been applied yet
+queued = [c for c, label in write_queue.queued(filtered_cands).items() if label is not None]
+filtered_cands = filtered_cands[~np.isin(filtered_cands, queued)]
+total = len(filtered_cands)
+page_num = total // img_ppage
 
 page_list = np.arange(1, page_num+2)
 
@@ -335,12 +169,25 @@ with container:
         st.markdown('[Back to Top](#hostless)')
 
     if page == page_list[-1]:
-        st.write(f"Showing: {img_ppage*(page-1)} - {len(candids)}                 Total: {len(candids)}")
+        st.write(f"Showing: {img_ppage*(page-1)} - {total}                 Total: {total}")
     else:
-        st.write(f"Showing: {img_ppage*(page-1)} - {(img_ppage*page)-1}                Total: {len(candids)}")
+        st.write(f"Showing: {img_ppage*(page-1)} - {(img_ppage*page)-1}                Total: {total}")
+
+def page_cands(page):
+    return filtered_cands[img_ppage*(page-1):img_ppage*page]
+
+if "hostless_prefetcher" not in st.session_state:
+    st.session_state["hostless_prefetcher"] = Prefetcher(engine)
+prefetcher = st.session_state["hostless_prefetcher"]
+prefetcher.wait(page)
+cutouts = get_images_from_db(page_cands(page))
+candids, sci, ref, diff, vmin, vmax = cutouts.unpack()
 
 page_load(page)
 
+# load the neighbouring pages into the cutout store in the background while this one is reviewed
+prefetcher.prefetch({p: page_cands(p) for p in (page + 1, page - 1) if 1 <= p <= page_list[-1]})
+
 # def button_click(candid):
 #     if candid not in st.session_state["incorrect"]:
 #         st.session_state["incorrect"].append(candid)
@@ -1,16 +1,14 @@
 import streamlit as st
 import astropy
-from astropy.io import fits
 import numpy as np
-import gzip
-import io
-from io import BytesIO
 import pandas as pd
-from sqlalchemy import create_engine, text, delete, insert, MetaData
-from astropy.stats import sigma_clipped_stats as scs
+from utils.db import get_engine
+from utils.classifications import classify, unclassify
+from utils.labels import locate_candidates
 import matplotlib.pyplot as plt
 from streamlit_float import *
-plt.rcParams['figure.max_open_warning'] = 101 
+from utils.cutout_cache import cached_candids
+from utils.render import render_triplet
 import seaborn as sns
 from matplotlib import colors
 # import pyperclip
@@ -38,110 +36,16 @@ if "expanded" not in st.session_state:
     st.session_state.expanded = True
 
 
-@st.cache_resource
-def init_connection():
-    db_user = st.secrets.wise_db.username
-    db_password = st.secrets.wise_db.password
-    db_host = st.secrets.wise_db.host
-    db_port = st.secrets.wise_db.port
-    db_name = st.secrets.wise_db.database
-
-    # Create SQLAlchemy engine
-    engine = create_engine(f'postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}')
-
-    return engine
-
-engine = init_connection()
-metadata = MetaData()
-metadata.reflect(bind=engine)
+engine = get_engine()
 
 @st.cache_data
 def get_count(incorrect_candids):
     count = len(incorrect_candids)
     return count
 
-@st.cache_data
-def get_ra_dec(candid):
-    df = pd.read_sql_query(f"""
-        SELECT ra, dec from candidates WHERE candid = {candid};""", engine)
-    ra = df.ra[0]
-    dec = df.dec[0]
-    return ra, dec
-
-@st.cache_data
 def get_images_from_db(incorrect_candids, limit = 1000):
-    
-    if len(incorrect_candids) > 1:
-        incorrect_candids = tuple(incorrect_candids)
-    else:
-        incorrect_candids = f"('{incorrect_candids[0]}')"
-    
-    query = f"""
-        SELECT c.candid, c.sci_image, c.ref_image, c.diff_image from cutouts c INNER JOIN (SELECT candid from candidates) s ON c.candid = s.candid WHERE c.candid IN {incorrect_candids} LIMIT {limit};"""
-    
-    images = pd.read_sql_query(query, engine)
-    
-    sci_images = []
-    ref_images = []
-    diff_images = []
-    candids = []
-    
-    params_dict = {"sci_vmin": [], "sci_vmax": [], "ref_vmin": [], "ref_vmax": [], "diff_vmin": [], "diff_vmax": []}
-    
-    for i in range(len(images)):
-        sci_image_b = images.sci_image[i]
-        ref_image_b = images.ref_image[i]
-        diff_image_b = images.diff_image[i]
-        candids.append(images.candid[i])
-        
-        sci_cutout = np.array(np.flipud(fits.open(BytesIO(gzip.open(io.BytesIO(sci_image_b), 'rb').read()))[0].data))
-        ref_cutout = np.array(np.flipud(fits.open(BytesIO(gzip.open(io.BytesIO(ref_image_b), 'rb').read()))[0].data))
-        diff_cutout = np.array(np.flipud(fits.open(BytesIO(gzip.open(io.BytesIO(diff_image_b), 'rb').read()))[0].data))
-        sci_images.append(sci_cutout)
-        ref_images.append(ref_cutout)
-        diff_images.append(diff_cutout)
-    
-        sci_mean, sci_median, sci_std = scs(sci_cutout)
-        ref_mean, ref_median, ref_std = scs(ref_cutout)
-        diff_mean, diff_median, diff_std = scs(diff_cutout)
-        
-        
-        lowp = 1
-        highp = 5
-        vmin = sci_median - lowp * sci_std
-        vmax = sci_median + highp * sci_std
-        params_dict["sci_vmin"].append(vmin)
-        params_dict["sci_vmax"].append(vmax)
-        vmin = ref_median - lowp * ref_std
-        vmax = ref_median + highp * ref_std
-        params_dict["ref_vmin"].append(vmin)
-        params_dict["ref_vmax"].append(vmax)
-        vmin = diff_median - lowp * diff_std
-        vmax = diff_median + highp * diff_std
-        params_dict["diff_vmin"].append(vmin)
-        params_dict["diff_vmax"].append(vmax)
-
-    return candids, sci_images, ref_images, diff_images, params_dict
+    return cached_candids(engine, incorrect_candids, limit)
  
-def plot_triplet(i, candid, sci, ref, diff):
-    fig, ax = plt.subplots(1, 3, figsize = (10, 3))
-    ax = ax.flatten()
-
-    ax[0].imshow(sci, cmap='gray', interpolation = 'nearest', aspect = 'equal', vmin = params["sci_vmin"][i], vmax = params["sci_vmax"][i])
-    ax[1].imshow(ref, cmap='gray', interpolation = 'nearest', aspect = 'equal', vmin = params["ref_vmin"][i], vmax = params["ref_vmax"][i])
-    ax[2].imshow(diff, cmap='gray', interpolation = 'nearest', aspect = 'equal', vmin = params["diff_vmin"][i], vmax = params["diff_vmax"][i])
-    # Add a title and axis labels (optional)
-    fig.suptitle(f'cand: {candid}', x = 0.5, y = 1.05, fontsize = 16)
-    ax[0].set_title('sci', fontsize = 12)
-    ax[1].set_title('ref', fontsize = 12)
-    ax[2].set_title('diff', fontsize = 12)
-    
-    for a in ax:
-        a.axis('off')
-    plt.subplots_adjust(left=None, bottom=None, right=None, top=None, wspace=None, hspace=None)
-    
-    return fig
-
 # def submit():
 #     st.session_state.submitted = True
 
@@ -227,7 +131,9 @@ if uploaded_file is not None:
     if len(cands) == 0:
         st.toast("No images found, try again with different parameters.")
     
-    candids, sci, ref, diff, params = get_images_from_db(cands, limit)
+    cutouts = get_images_from_db(cands, limit)
+    
+    candids, sci, ref, diff, vmin, vmax = cutouts.unpack()
     
 # except:
 #     st.write("No misclassified images found.")
@@ -281,92 +187,34 @@ def button_click(candid):
 
 
 def delete_candidate(engine, source, candid, write = False):
-    with engine.connect() as con:
-        try:
-            table = metadata.tables.get(source)
-            query = delete(table).where(table.c.candid == str(candid))
-            
-            con.execute(query)
-            con.commit()
-            st.toast(f"Deleted candidate {candid} from {source}.")
-        except:
-            st.toast(f"Could not delete candidate {candid} from {source}.")
-            st.stop()
+    try:
+        unclassify(engine, candid, source)
+        st.toast(f"Deleted candidate {candid} from {source}.")
+    except:
+        st.toast(f"Could not delete candidate {candid} from {source}.")
+        st.stop()
     if write:
         record_df.drop(index = record_df.loc[record_df["candid"] == str(candid)].index, inplace = True)
         record_df.to_csv("log.csv", index = False)
     
+
 def insert_candidate(engine, source, candid):
-    
-    max_id = get_id(engine, source)
-    correct_col = f"{source}id"
-    data = ({correct_col: max_id+1, "candid": str(candid)})
-    
-    with engine.connect() as con:
-        try:
-            table = metadata.tables.get(source)
-            query = insert(table).values(**data) #INSERT INTO reals (realsid, candid) VALUES (%(realsid)s, %(candid)s)
-            # st.toast(str(query.compile(engine, compile_kwargs={"literal_binds": True})))
-            con.execute(query)
-            con.commit()
-        except:
-            st.toast(f"Could not insert candidate {candid} into {source}.")
-            st.stop()
-
-
-def locate_candidate(engine, candid):
-    with engine.connect() as con:
-        try:
-            query = f"(SELECT 'reals' AS table_name, * FROM reals WHERE candid = {candid}) UNION (SELECT 'artifact' AS table_name, * from artifact WHERE candid = {candid}) UNION (SELECT 'echo' AS table_name, * from echo WHERE candid = {candid}) UNION (SELECT 'highpm' AS table_name, * from highpm WHERE candid = {candid})"
-            result = con.execute(text(query))
-            row = result.fetchall()
-            source = row[0][0]
-            candid = row[0][2]
-        except:
-            # st.toast(f"Could not locate candidate {candid}.")
-            return None, candid
-    return source, candid
-
-def get_id(engine, source):
-    with engine.connect() as con:
-        try:
-            query = f"SELECT MAX({source}id) FROM {source}"
-            result = con.execute(text(query))
-            id = result.fetchone()[0]
-        except:
-            st.toast(f"Could not get ID for {source}.")
-            st.stop()
-    return(id)
-    
-    
+    try:
+        classify(engine, candid, source)
+    except:
+        st.toast(f"Could not insert candidate {candid} into {source}.")
+        st.stop()
+
+
+
 def change_class(engine, candid, old_source, new_source):
-    
-    if old_source == new_source: # if the candidate is already in the new source, then do nothing
-        st.toast(f"Candidate {candid} is already classified as {new_source}. Removing from page.")
-        # record_df.drop(index = record_df.loc[record_df["candid"] == str(candid)].index, inplace = True)
-        # record_df.to_csv("log.csv", index = False)
-    if old_source == None:
-        
-        with engine.connect() as con:
-            try:
-                insert_candidate(engine, new_source, candid)
-                st.toast(f"Reclassified candidate {candid} as {new_source}.")
-                
-            except:
-                st.toast(f"Could not reclassify candidate {candid} as {new_source}.")
-                st.stop()
-    
-    else:
-        delete_candidate(engine, old_source, candid) # delete the candidate from the original source
-        with engine.connect() as con:
-            try:
-                insert_candidate(engine, new_source, candid)
-                st.toast(f"Reclassified candidate {candid} as {new_source}.")
-                # record_df.drop(index = (record_df.loc[record_df["candid"] == str(candid)].index), inplace = True)
-                # record_df.to_csv("log.csv", index = False)
-            except:
-                st.toast(f"Could not reclassify candidate {candid} as {new_source}.")
-                st.stop()
+    try:
+        classify(engine, candid, new_source) # one upsert replaces old_source, if there was one
+        st.toast(f"Reclassified candidate {candid} as {new_source}.")
+    except:
+        st.toast(f"Could not reclassify candidate {candid} as {new_source}.")
+        st.stop()
+
 
 def find_label(candid, pred_csv = pred_csv):
     # st.toast(type(candid))
@@ -436,19 +284,18 @@ def confusion_matrix(binary):
 
 
 def page_load_model_misclass(page):
-    
+    labels = locate_candidates(engine, candids[img_ppage*(page-1):img_ppage*page]) # one query for the page
     if page == page_list[-1]: # if last page, then only load the remaining images
         for i in range(img_ppage*(page-1), len(candids)):
             pred, true, probs = find_label(candids[i]) # tells you predicted value
-            db_source, _ = locate_candidate(engine, candids[i]) # tells you what source
+            db_source = labels.get(candids[i], [None])[0] # tells you what source
             
             if truth_check:
                 st.header(f"{i} - predicted {pred} for {candids[i]} (true {db_source})")
             else:
                 st.header(f"{i} - predicted {pred} for {candids[i]}")
             st.write(probs)
-            fig = plot_triplet(i, candids[i], sci[i], ref[i], diff[i])
-            st.pyplot(fig)
+            render_triplet(candids[i], sci[i], ref[i], diff[i], vmin[i], vmax[i])
             col1, col2, col3, col4, col5 = st.columns([0.2, 0.2, 0.2, 0.2, 0.2])
             with col1:
                 if st.button("Artifact", key = i):
@@ -470,21 +317,20 @@ def page_load_model_misclass(page):
             #     if st.button("Delete", key = i+4e5):
             #         delete_candidate(engine, current_source, candids[i], write = True)
                     # st.rerun() 
-            ra, dec = get_ra_dec(candids[i])
+            ra, dec = cutouts.ra[i], cutouts.dec[i]
             byworlds = f"http://byw.tools/wiseview#ra={ra}&dec={dec}&size=176&band=2&speed=234.62&minbright=-2.3497&maxbright=963.1413&window=0.09958&diff_window=1&linear=1&color=&zoom=10&border=0&gaia=0&invert=0&maxdyr=0&scandir=0&neowise=0&diff=0&outer_epochs=0&unique_window=1&smooth_scan=0&shift=0&pmra=0&pmdec=0&synth_a=0&synth_a_sub=0&synth_a_ra=&synth_a_dec=&synth_a_w1=&synth_a_w2=&synth_a_pmra=0&synth_a_pmdec=0&synth_a_mjd=&synth_b=0&synth_b_sub=0&synth_b_ra=&synth_b_dec=&synth_b_w1=&synth_b_w2=&synth_b_pmra=0&synth_b_pmdec=0&synth_b_mjd="
             st.link_button("See in BYW", url = byworlds)
     else: # load 100 images per page
         for img in range(img_ppage*(page-1), img_ppage*page):
             pred, true, probs = find_label(candids[img]) # tells you predicted value
-            db_source, _ = locate_candidate(engine, candids[img]) # tells you what source
+            db_source = labels.get(candids[img], [None])[0] # tells you what source
             
             if truth_check:
                 st.header(f"{img} - predicted {pred} for {candids[img]} (true {db_source})")
             else:
                 st.header(f"{img} - predicted {pred} for {candids[img]}")
             st.write(probs)
-            fig = plot_triplet(img, candids[img], sci[img], ref[img], diff[img])
-            st.pyplot(fig)
+            render_triplet(candids[img], sci[img], ref[img], diff[img], vmin[img], vmax[img])
             col1, col2, col3, col4, col5 = st.columns([0.2, 0.2, 0.2, 0.2, 0.2])
             with col1:
                 if st.button("Artifact", key = img):
@@ -507,7 +353,7 @@ def page_load_model_misclass(page):
             #     if st.button("Delete", key = img+4e5):
             #         delete_candidate(engine, current_source, candids[img], write = True)
                     # st.rerun()
-            ra, dec = get_ra_dec(candids[img])
+            ra, dec = cutouts.ra[img], cutouts.dec[img]
             byworlds = f"http://byw.tools/wiseview#ra={ra}&dec={dec}&size=176&band=2&speed=234.62&minbright=-2.3497&maxbright=963.1413&window=0.09958&diff_window=1&linear=1&color=&zoom=10&border=0&gaia=0&invert=0&maxdyr=0&scandir=0&neowise=0&diff=0&outer_epochs=0&unique_window=1&smooth_scan=0&shift=0&pmra=0&pmdec=0&synth_a=0&synth_a_sub=0&synth_a_ra=&synth_a_dec=&synth_a_w1=&synth_a_w2=&synth_a_pmra=0&synth_a_pmdec=0&synth_a_mjd=&synth_b=0&synth_b_sub=0&synth_b_ra=&synth_b_dec=&synth_b_w1=&synth_b_w2=&synth_b_pmra=0&synth_b_pmdec=0&synth_b_mjd="
             st.link_button("See in BYW", url = byworlds)
 
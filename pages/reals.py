@@ -1,19 +1,16 @@
 import streamlit as st
 import astropy
-from astropy.io import fits
 import numpy as np
-import gzip
-import io
-from io import BytesIO
 import pandas as pd
-from sqlalchemy import create_engine, delete, MetaData
-from astropy.stats import sigma_clipped_stats as scs
-import matplotlib.pyplot as plt
-import matplotlib
+from utils.db import get_engine
+from utils.classifications import unclassify
 from streamlit_float import *
+from utils.cutouts import page_candids, count_rows
+from utils.cutout_cache import cached_candids
+from utils.render import render_triplet
+from utils.prefetch import Prefetcher
 
 st.set_page_config(page_title="Reals", page_icon="🌟", layout = "wide")
-plt.rcParams.update({"figure.max_open_warning": 50})
 
 ## Check if the user is logged in
 login_page = st.Page("./pages/login.py", title = "Login")
@@ -32,108 +29,19 @@ if st.session_state.get('logout'):
     st.switch_page(login_page)
 
 
-@st.cache_resource
-def init_connection():
-    db_user = st.secrets.wise_db.username
-    db_password = st.secrets.wise_db.password
-    db_host = st.secrets.wise_db.host
-    db_port = st.secrets.wise_db.port
-    db_name = st.secrets.wise_db.database
-
-    # Create SQLAlchemy engine
-    engine = create_engine(f'postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}')
-
-    return engine
-
-
-engine = init_connection()
-metadata = MetaData()
-metadata.reflect(bind=engine)
+engine = get_engine()
 
 @st.cache_data
 def get_count(source):
-    count = pd.read_sql_query(f"""
-        SELECT COUNT(DISTINCT(candid)) from {source};""", engine)
-    return count.values[0][0]
+    return count_rows(engine, source)
 
-@st.cache_data
-def get_ra_dec(candid):
-    df = pd.read_sql_query(f"""
-        SELECT ra, dec from candidates WHERE candid = {candid};""", engine)
-    ra = df.ra[0]
-    dec = df.dec[0]
-    return ra, dec
+def get_images_from_db(source, page, after):
+    candids, last_id = page_candids(engine, source, img_ppage, page, after)
+    return cached_candids(engine, candids), last_id
 
-@st.cache_data
-def get_images_from_db(source):
-
-    images = pd.read_sql_query(f"""
-        SELECT c.candid, c.sci_image, c.ref_image, c.diff_image from cutouts c INNER JOIN (SELECT DISTINCT(candid) from {source}) s ON c.candid = s.candid;""", engine)
-
-    sci_images = []
-    ref_images = []
-    diff_images = []
-    candids = []
-    
-    params_dict = {"sci_vmin": [], "sci_vmax": [], "ref_vmin": [], "ref_vmax": [], "diff_vmin": [], "diff_vmax": []}
-    
-    for i in range(len(images)):
-        sci_image_b = images.sci_image[i]
-        ref_image_b = images.ref_image[i]
-        diff_image_b = images.diff_image[i]
-        candids.append(images.candid[i])
-        
-        sci_cutout = np.flipud(fits.open(BytesIO(gzip.open(io.BytesIO(sci_image_b), 'rb').read()))[0].data)
-        ref_cutout = np.flipud(fits.open(BytesIO(gzip.open(io.BytesIO(ref_image_b), 'rb').read()))[0].data)
-        diff_cutout = np.flipud(fits.open(BytesIO(gzip.open(io.BytesIO(diff_image_b), 'rb').read()))[0].data)
-        sci_images.append(sci_cutout)
-        ref_images.append(ref_cutout)
-        diff_images.append(diff_cutout)
-    
-        sci_mean, sci_median, sci_std = scs(sci_cutout)
-        ref_mean, ref_median, ref_std = scs(ref_cutout)
-        diff_mean, diff_median, diff_std = scs(diff_cutout)
-        
-        
-        lowp = 1
-        highp = 5
-        vmin = sci_median - lowp * sci_std
-        vmax = sci_median + highp * sci_std
-        params_dict["sci_vmin"].append(vmin)
-        params_dict["sci_vmax"].append(vmax)
-        vmin = ref_median - lowp * ref_std
-        vmax = ref_median + highp * ref_std
-        params_dict["ref_vmin"].append(vmin)
-        params_dict["ref_vmax"].append(vmax)
-        vmin = diff_median - lowp * diff_std
-        vmax = diff_median + highp * diff_std
-        params_dict["diff_vmin"].append(vmin)
-        params_dict["diff_vmax"].append(vmax)
-
-    return candids, sci_images, ref_images, diff_images, params_dict
+img_ppage = 50
 
 record_df = pd.read_csv("log.csv", dtype = str, skipinitialspace=True, header=0)
-candids, sci, ref, diff, params = get_images_from_db("reals")
-
-@st.cache_data(hash_funcs={matplotlib.figure.Figure: hash})
-def plot_triplet(i, candid, sci, ref, diff):
-    fig, ax = plt.subplots(1, 3, figsize = (10, 3))
-    ax = ax.flatten()
-
-    ax[0].imshow(sci, cmap='gray', interpolation = 'nearest', aspect = 'equal', vmin = params["sci_vmin"][i], vmax = params["sci_vmax"][i])
-    ax[1].imshow(ref, cmap='gray', interpolation = 'nearest', aspect = 'equal', vmin = params["ref_vmin"][i], vmax = params["ref_vmax"][i])
-    ax[2].imshow(diff, cmap='gray', interpolation = 'nearest', aspect = 'equal', vmin = params["diff_vmin"][i], vmax = params["diff_vmax"][i])
-    # Add a title and axis labels (optional)
-    fig.suptitle(f'cand: {candid}', x = 0.5, y = 1.05, fontsize = 16)
-    ax[0].set_title('sci', fontsize = 12)
-    ax[1].set_title('ref', fontsize = 12)
-    ax[2].set_title('diff', fontsize = 12)
-    
-    for a in ax:
-        a.axis('off')
-    plt.subplots_adjust(left=None, bottom=None, right=None, top=None, wspace=None, hspace=None)
-    
-    return fig
 
 
 
@@ -161,24 +69,19 @@ def button_click(candid, current, likely):
         st.toast(f"Marked {candid} as incorrect")
 
 def delete_candidate(engine, source, candid, write = False):
-    with engine.connect() as con:
-        try:
-            table = metadata.tables.get(source)
-            query = delete(table).where(table.c.candid == str(candid))
-            
-            con.execute(query)
-            con.commit()
-            st.toast(f"Deleted candidate {candid} from {source}.")
-        except:
-            st.toast(f"Could not delete candidate {candid} from {source}.")
-            st.stop()
+    try:
+        unclassify(engine, candid, source)
+        st.toast(f"Deleted candidate {candid} from {source}.")
+    except:
+        st.toast(f"Could not delete candidate {candid} from {source}.")
+        st.stop()
     if write:
         record_df.drop(index = record_df.loc[record_df["candid"] == str(candid)].index, inplace = True)
         record_df.to_csv("log.csv", index = False)
 
 
-img_ppage = 50
-page_num = len(candids) // img_ppage
+total = get_count("reals")
+page_num = total // img_ppage
 
 page_list = np.arange(1, page_num+2)
 
@@ -199,66 +102,48 @@ with container:
         st.markdown('[Back to Top](#reals)')
         
     if page == page_list[-1]:
-        st.write(f"Showing: {img_ppage*(page-1)} - {len(candids)}                 Total: {len(candids)}")
+        st.write(f"Showing: {img_ppage*(page-1)} - {total}                 Total: {total}")
     else:
-        st.write(f"Showing: {img_ppage*(page-1)} - {(img_ppage*page)-1}                Total: {len(candids)}")
+        st.write(f"Showing: {img_ppage*(page-1)} - {(img_ppage*page)-1}                Total: {total}")
         
 current_source = "reals"
 
+page_keys = st.session_state.setdefault("reals_page_keys", {}) # page -> last id of the page before it
+if "reals_prefetcher" not in st.session_state:
+    st.session_state["reals_prefetcher"] = Prefetcher(engine)
+prefetcher = st.session_state["reals_prefetcher"]
+prefetcher.wait(page)
+cutouts, last_id = get_images_from_db("reals", page, page_keys.get(page))
+page_keys[page+1] = last_id
+candids, sci, ref, diff, vmin, vmax = cutouts.unpack()
+
 def page_load(page):
-    if page == page_list[-1]: # if last page, then only load the remaining images
-        for i in range(img_ppage*(page-1), len(candids)):
-            
-            st.header(i)
-            fig = plot_triplet(i, candids[i], sci[i], ref[i], diff[i])
-            st.pyplot(fig)
+    start = img_ppage*(page-1)
+    for j in range(len(candids)): # only the current page is loaded
+        img = start + j
+        st.header(img)
+        render_triplet(candids[j], sci[j], ref[j], diff[j], vmin[j], vmax[j])
             
-            col1, col2, col3, col4, col5 = st.columns([0.2, 0.2, 0.2, 0.2, 0.2])
-            with col1:
-                if st.button("Artifact", key = i):
-                    button_click(candids[i], current_source, "artifact")
-            with col2:
-                if st.button("Real", key = i+1e5):
-                    button_click(candids[i], current_source, "reals")
-            with col3:
-                if st.button("Echo", key = i+2e5):
-                    button_click(candids[i], current_source, "echo")
-            with col4:
-                if st.button("High PM", key = i+3e5):
-                    button_click(candids[i], current_source, "highpm")
-            with col5:
-                if st.button("Delete", key = i+4e5):
-                    delete_candidate(engine, current_source, candids[i], write = True)
-                    st.rerun() 
-            ra, dec = get_ra_dec(candids[i])
-            byworlds = f"http://byw.tools/wiseview#ra={ra}&dec={dec}&size=176&band=2&speed=234.62&minbright=-2.3497&maxbright=963.1413&window=0.09958&diff_window=1&linear=1&color=&zoom=10&border=0&gaia=0&invert=0&maxdyr=0&scandir=0&neowise=0&diff=0&outer_epochs=0&unique_window=1&smooth_scan=0&shift=0&pmra=0&pmdec=0&synth_a=0&synth_a_sub=0&synth_a_ra=&synth_a_dec=&synth_a_w1=&synth_a_w2=&synth_a_pmra=0&synth_a_pmdec=0&synth_a_mjd=&synth_b=0&synth_b_sub=0&synth_b_ra=&synth_b_dec=&synth_b_w1=&synth_b_w2=&synth_b_pmra=0&synth_b_pmdec=0&synth_b_mjd="
-            st.link_button("See in BYW", url = byworlds)
-    else: # load 100 images per page
-        for img in range(img_ppage*(page-1), img_ppage*page):
-            st.header(img)
-            fig = plot_triplet(img, candids[img], sci[img], ref[img], diff[img])
-            st.pyplot(fig)
-            
-            col1, col2, col3, col4, col5 = st.columns([0.2, 0.2, 0.2, 0.2, 0.2])
-            with col1:
-                if st.button("Artifact", key = img):
-                    button_click(candids[img], current_source, "artifact")
-            with col2:
-                if st.button("Real", key = img+1e5):
-                    button_click(candids[img], current_source, "reals")
-            with col3:
-                if st.button("Echo", key = img+2e5):
-                    button_click(candids[img], current_source, "echo")
-            with col4:
-                if st.button("High PM", key = img+3e5):
-                    button_click(candids[img], current_source, "highpm")
-            with col5:
-                if st.button("Delete", key = img+4e5):
-                    delete_candidate(engine, current_source, candids[img], write = True)
-                    st.rerun()
-            ra, dec = get_ra_dec(candids[img])
-            byworlds = f"http://byw.tools/wiseview#ra={ra}&dec={dec}&size=176&band=2&speed=234.62&minbright=-2.3497&maxbright=963.1413&window=0.09958&diff_window=1&linear=1&color=&zoom=10&border=0&gaia=0&invert=0&maxdyr=0&scandir=0&neowise=0&diff=0&outer_epochs=0&unique_window=1&smooth_scan=0&shift=0&pmra=0&pmdec=0&synth_a=0&synth_a_sub=0&synth_a_ra=&synth_a_dec=&synth_a_w1=&synth_a_w2=&synth_a_pmra=0&synth_a_pmdec=0&synth_a_mjd=&synth_b=0&synth_b_sub=0&synth_b_ra=&synth_b_dec=&synth_b_w1=&synth_b_w2=&synth_b_pmra=0&synth_b_pmdec=0&synth_b_mjd="
-            st.link_button("See in BYW", url = byworlds)
+        col1, col2, col3, col4, col5 = st.columns([0.2, 0.2, 0.2, 0.2, 0.2])
+        with col1:
+            if st.button("Artifact", key = img):
+                button_click(candids[j], current_source, "artifact")
+        with col2:
+            if st.button("Real", key = img+1e5):
+                button_click(candids[j], current_source, "reals")
+        with col3:
+            if st.button("Echo", key = img+2e5):
+                button_click(candids[j], current_source, "echo")
+        with col4:
+            if st.button("High PM", key = img+3e5):
+                button_click(candids[j], current_source, "highpm")
+        with col5:
+            if st.button("Delete", key = img+4e5):
+                delete_candidate(engine, current_source, candids[j], write = True)
+                st.rerun()
+        ra, dec = cutouts.ra[j], cutouts.dec[j]
+        byworlds = f"http://byw.tools/wiseview#ra={ra}&dec={dec}&size=176&band=2&speed=234.62&minbright=-2.3497&maxbright=963.1413&window=0.09958&diff_window=1&linear=1&color=&zoom=10&border=0&gaia=0&invert=0&maxdyr=0&scandir=0&neowise=0&diff=0&outer_epochs=0&unique_window=1&smooth_scan=0&shift=0&pmra=0&pmdec=0&synth_a=0&synth_a_sub=0&synth_a_ra=&synth_a_dec=&synth_a_w1=&synth_a_w2=&synth_a_pmra=0&synth_a_pmdec=0&synth_a_mjd=&synth_b=0&synth_b_sub=0&synth_b_ra=&synth_b_dec=&synth_b_w1=&synth_b_w2=&synth_b_pmra=0&synth_b_pmdec=0&synth_b_mjd="
+        st.link_button("See in BYW", url = byworlds)
 
 st.write("#")
 st.write("#")
@@ -267,3 +152,7 @@ st.write("#")
 st.markdown("# Reals")
 
 page_load(page)
+
+# load the neighbouring pages into the cutout store in the background while this one is reviewed
+prefetcher.prefetch({p: lambda p = p: page_candids(engine, "reals", img_ppage, p, page_keys.get(p))[0]
+                     for p in (page + 1, page - 1) if 1 <= p <= page_list[-1]})
@@ -2,9 +2,12 @@ import streamlit as st
 import astropy
 from astropy.io import fits
 import pandas as pd
-from sqlalchemy import create_engine, delete, MetaData, text
+from sqlalchemy import text
+from utils.db import get_engine
 import matplotlib.pyplot as plt
 import numpy as np
+from utils.cutout_cache import default_cache
+from utils.queries import run_query, fetch
 
 st.set_page_config(page_title="Stats", page_icon="📊", layout = "wide")
 
@@ -25,53 +28,34 @@ if st.session_state.get('logout'):
     st.switch_page(login_page)
 
 
-@st.cache_resource
-def init_connection():
-    db_user = st.secrets.wise_db.username
-    db_password = st.secrets.wise_db.password
-    db_host = st.secrets.wise_db.host
-    db_port = st.secrets.wise_db.port
-    db_name = st.secrets.wise_db.database
-
-    # Create SQLAlchemy engine
-    engine = create_engine(f'postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}')
-
-    return engine
-
-
-engine = init_connection()
-metadata = MetaData()
-metadata.reflect(bind=engine)
+engine = get_engine()
 
 def get_total_counts():
-    with engine.connect() as conn:
-        query = """
-            SELECT (SELECT COUNT(DISTINCT(candid)) FROM reals) AS count1, (SELECT COUNT(DISTINCT(candid)) FROM highpm) AS count2, (SELECT COUNT(DISTINCT(candid)) FROM echo) AS count3, (SELECT COUNT(DISTINCT(candid)) FROM artifact) AS count4;"""
-        result = conn.execute(text(query))
-        record = result.fetchone()
-        num_artifacts = record[3]
-        num_reals = record[0]
-        num_highpm = record[1]
-        num_echo = record[2]
-        total = num_artifacts + num_reals + num_highpm + num_echo
+    query = """
+        SELECT (SELECT COUNT(DISTINCT(candid)) FROM reals) AS count1, (SELECT COUNT(DISTINCT(candid)) FROM highpm) AS count2, (SELECT COUNT(DISTINCT(candid)) FROM echo) AS count3, (SELECT COUNT(DISTINCT(candid)) FROM artifact) AS count4;"""
+    record = run_query(engine, "Counting candidates", lambda handle: fetch(engine, query, handle = handle),
+                       key = "stats_total").iloc[0].tolist()
+    num_artifacts = record[3]
+    num_reals = record[0]
+    num_highpm = record[1]
+    num_echo = record[2]
     
     counts = {"artifact": num_artifacts, "reals": num_reals, "highpm": num_highpm, "echo": num_echo}
     return counts
 
 def get_dup_counts(table):
-    with engine.connect() as conn:
-        query = """
-            SELECT (SELECT COUNT(candid) FROM reals) AS count1, (SELECT COUNT(candid) FROM highpm) AS count2, (SELECT COUNT(candid) FROM echo) AS count3, (SELECT COUNT(candid) FROM artifact) AS count4;"""
-        result = conn.execute(text(query))
-        record = result.fetchone()
-        
-        unique_counts = get_total_counts()
-        num_artifacts = record[3] - unique_counts["artifact"]
-        num_reals = record[0] - unique_counts["reals"]
-        num_highpm = record[1] - unique_counts["highpm"]
-        num_echo = record[2] - unique_counts["echo"]
-        
-        dup_counts = {"artifact": num_artifacts, "reals": num_reals, "highpm": num_highpm, "echo": num_echo}
+    query = """
+        SELECT (SELECT COUNT(candid) FROM reals) AS count1, (SELECT COUNT(candid) FROM highpm) AS count2, (SELECT COUNT(candid) FROM echo) AS count3, (SELECT COUNT(candid) FROM artifact) AS count4;"""
+    record = run_query(engine, "Counting duplicates", lambda handle: fetch(engine, query, handle = handle),
+                       key = "stats_dup").iloc[0].tolist()
+    
+    unique_counts = get_total_counts()
+    num_artifacts = record[3] - unique_counts["artifact"]
+    num_reals = record[0] - unique_counts["reals"]
+    num_highpm = record[1] - unique_counts["highpm"]
+    num_echo = record[2] - unique_counts["echo"]
+    
+    dup_counts = {"artifact": num_artifacts, "reals": num_reals, "highpm": num_highpm, "echo": num_echo}
     return dup_counts
 
 
@@ -88,6 +72,11 @@ dup_counts = get_dup_counts("artifact")
 dup_df = pd.DataFrame.from_dict(dup_counts, orient='index', columns=['count'])
 st.dataframe(dup_df, width = 200)
 
+st.write("## Cutout Cache")
+footprint = default_cache().footprint()
+st.write(f"{footprint['entries']} pages cached, {footprint['nbytes'] / 1e6:.0f} of {footprint['max_bytes'] / 1e6:.0f} MB "
+         f"({footprint['hits']} hits, {footprint['misses']} misses)")
+
 def delete_duplicates(table):
     with engine.connect() as conn:
         delete_query = f"""DELETE FROM {table}
@@ -0,0 +1,69 @@
+import pytest
+from sqlalchemy import create_engine, text
+
+from utils.classified_index import ClassifiedIndex
+from utils.db import LABEL_TABLES
+from utils.write_queue import WriteQueue
+
+LABEL = LABEL_TABLES[0]
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'labels.db'}")
+    with engine.begin() as con:
+        con.execute(text("CREATE TABLE classifications (id integer PRIMARY KEY, candid bigint NOT NULL UNIQUE, "
+                         "label text NOT NULL)"))
+        con.execute(text("INSERT INTO classifications (candid, label) VALUES (5, :label), (3, :label)"), {"label": LABEL})
+    return engine
+
+
+def execute(engine, sql):
+    with engine.begin() as con:
+        con.execute(text(sql), {"label": LABEL})
+
+
+def test_refresh_picks_up_new_and_removed_labels(engine):
+    index = ClassifiedIndex(engine, interval = 0)
+    assert 5 in index and 4 not in index and len(index) == 2
+    assert index.isin([3, 4, 5]).tolist() == [True, False, True]
+    assert index.exclude([9, 5, 4, 3]).tolist() == [9, 4]
+
+    execute(engine, "INSERT INTO classifications (candid, label) VALUES (4, :label)")
+    assert 4 in index
+    execute(engine, "DELETE FROM classifications WHERE candid = 5") # only the row count shows this
+    assert 5 not in index and len(index) == 2
+
+
+def test_lookups_within_the_interval_dont_query(engine):
+    index = ClassifiedIndex(engine, interval = 60)
+    assert 4 not in index
+    execute(engine, "INSERT INTO classifications (candid, label) VALUES (4, :label)")
+    assert 4 not in index
+    index.refresh(force = True)
+    assert 4 in index
+
+
+def test_written_candids_are_indexed_before_they_leave_the_queue(engine):
+    # interval = 60: without the queue telling it, the index would not see the write for a minute
+    index = ClassifiedIndex(engine, interval = 60)
+    writes = WriteQueue(engine, index = index)
+    assert 4 not in index
+
+    writes.classify(4, LABEL, replace = False)
+    assert writes.flush(timeout = 5)
+    assert 4 in index and not writes.queued([4])
+
+    writes.unclassify(4)
+    assert writes.flush(timeout = 5)
+    assert 4 not in index
+
+
+def test_failed_writes_are_not_indexed(engine):
+    index = ClassifiedIndex(engine, interval = 60)
+    writes = WriteQueue(engine, index = index)
+    assert 4 not in index
+    execute(engine, "DROP TABLE classifications")
+    writes.classify(4, LABEL, replace = False)
+    assert writes.flush(timeout = 5)
+    assert writes.failed() and 4 not in index
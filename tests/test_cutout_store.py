@@ -0,0 +1,41 @@
+import os
+import shutil
+
+import numpy as np
+
+from utils.cutouts import Cutouts
+from utils.cutout_store import CutoutStore
+
+
+def cutouts(candids, value = 0.0):
+    candids = np.asarray(candids, dtype = np.int64)
+    images = np.full((len(candids), 3, 4, 4), value, dtype = np.float32) + candids[:, None, None, None]
+    return Cutouts(candids, images, np.zeros((len(candids), 3)), np.ones((len(candids), 3)))
+
+
+def segments(path):
+    return sorted(name for name in os.listdir(path) if name.startswith("seg-"))
+
+
+def test_small_puts_share_a_segment(tmp_path):
+    store = CutoutStore(str(tmp_path))
+    for start in range(0, 100, 25):
+        store.put(cutouts(range(start, start + 25)))
+    assert len(segments(tmp_path)) == 1
+
+    found, missing = store.get(range(0, 110))
+    assert len(missing) == 10
+    np.testing.assert_array_equal(found.candids, np.arange(100))
+    np.testing.assert_array_equal(found.images[:, 0, 0, 0], np.arange(100))
+
+
+def test_reset_store_does_not_serve_stale_mappings(tmp_path):
+    store = CutoutStore(str(tmp_path))
+    store.put(cutouts([1, 2]))
+    assert store.get([1])[0].images[0, 0, 0, 0] == 1
+
+    # another process wipes the store and starts over, reusing segment 0
+    shutil.rmtree(tmp_path)
+    other = CutoutStore(str(tmp_path))
+    other.put(cutouts([1, 2], value = 100))
+    assert store.get([1])[0].images[0, 0, 0, 0] == 101
@@ -0,0 +1,106 @@
+import gzip
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+
+from utils import cutouts
+from utils.cutouts import _decode_triplets, decode_rows, display_limits
+
+
+def blob(shape, seed = 0):
+    data = np.random.default_rng(seed).normal(100, 10, shape).astype(np.float32)
+    buf = BytesIO()
+    fits.PrimaryHDU(data).writeto(buf)
+    return gzip.compress(buf.getvalue()), np.flipud(data)
+
+
+def test_mixed_sizes_are_padded_not_cropped():
+    small, small_img = blob((40, 63), 1)
+    large, large_img = blob((63, 63), 2)
+    stack = _decode_triplets([(small, small, small), (large, large, large)])
+
+    assert stack.shape == (2, 3, 63, 63)
+    np.testing.assert_array_equal(stack[1, 0], large_img)
+    np.testing.assert_array_equal(stack[0, 0, :40], small_img)
+    assert np.isnan(stack[0, 0, 40:]).all()
+    # the stretch of the larger cutout sees all of its pixels
+    np.testing.assert_allclose(display_limits(stack[1:])[0], display_limits(large_img[None, None])[0][:, :1].repeat(3, 1))
+
+def test_mixed_sizes_across_chunks(monkeypatch):
+    monkeypatch.setattr(cutouts, "PARALLEL_MIN_ROWS", 0)
+    small, _ = blob((40, 63), 1)
+    large, large_img = blob((63, 63), 2)
+    rows = pd.DataFrame({band: [small] * 3 + [large] * 3 for band in ("sci_image", "ref_image", "diff_image")})
+    stack, vmin, vmax = decode_rows(rows, workers = 2, chunksize = 3)
+    serial = decode_rows(rows, workers = 1)
+
+    assert stack.shape == (6, 3, 63, 63)
+    np.testing.assert_array_equal(stack[5, 0], large_img)
+    np.testing.assert_array_equal(np.isnan(stack), np.isnan(serial[0]))
+    np.testing.assert_allclose(vmin, serial[1])
+    np.testing.assert_allclose(vmax, serial[2])
+
+
+def test_stream_saves_stats_with_one_pooled_connection(tmp_path, monkeypatch):
+    from sqlalchemy import create_engine
+    from sqlalchemy.pool import QueuePool
+    from utils.cutout_stats import CREATE_TABLE
+    from utils.cutouts import stream_candids
+
+    # one connection and no overflow: a second checkout while the cursor is open would time out
+    engine = create_engine(f"sqlite:///{tmp_path / 'db.sqlite'}", poolclass = QueuePool, pool_size = 1, max_overflow = 0,
+                           pool_timeout = 1)
+    data, _ = blob((8, 8))
+    with engine.begin() as con:
+        con.exec_driver_sql("CREATE TABLE cutouts (candid integer, sci_image blob, ref_image blob, diff_image blob)")
+        con.exec_driver_sql("CREATE TABLE candidates (candid integer, ra real, dec real, rbscore real, epochid integer)")
+        con.exec_driver_sql(CREATE_TABLE)
+        for candid in range(5):
+            con.exec_driver_sql("INSERT INTO cutouts VALUES (?, ?, ?, ?)", (candid, data, data, data))
+    monkeypatch.setattr(cutouts, "_has_stats_table", None)
+
+    batches = list(stream_candids(engine, range(5), batch = 2, workers = 1))
+    assert [len(b) for b in batches] == [2, 2, 1]
+    with engine.connect() as con:
+        assert con.exec_driver_sql("SELECT count(*) FROM cutout_stats").scalar() == 5
+
+
+def test_missing_stats_table_is_looked_for_again(tmp_path, monkeypatch):
+    from sqlalchemy import create_engine
+    from sqlalchemy.exc import ProgrammingError
+    from utils.cutout_stats import CREATE_TABLE
+    from utils.cutouts import stream_candids
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'db.sqlite'}")
+    data, _ = blob((8, 8))
+    with engine.begin() as con:
+        con.exec_driver_sql("CREATE TABLE cutouts (candid integer, sci_image blob, ref_image blob, diff_image blob)")
+        con.exec_driver_sql("CREATE TABLE candidates (candid integer, ra real, dec real, rbscore real, epochid integer)")
+        con.exec_driver_sql("INSERT INTO cutouts VALUES (?, ?, ?, ?)", (1, data, data, data))
+
+    # sqlite reports a missing table as OperationalError, postgres (what the code expects) as ProgrammingError
+    query, asked = cutouts._cutouts_query, []
+    def cutouts_query(limit, with_stats):
+        asked.append(with_stats)
+        with engine.connect() as con:
+            exists = con.exec_driver_sql("SELECT count(*) FROM sqlite_master WHERE name = 'cutout_stats'").scalar()
+        if with_stats and not exists:
+            raise ProgrammingError("SELECT", {}, Exception("relation cutout_stats does not exist"))
+        return query(limit, with_stats)
+    monkeypatch.setattr(cutouts, "_cutouts_query", cutouts_query)
+    monkeypatch.setattr(cutouts, "_has_stats_table", None)
+
+    list(stream_candids(engine, [1], workers = 1))
+    assert asked == [True, False]
+    with engine.begin() as con:
+        con.exec_driver_sql(CREATE_TABLE)
+    list(stream_candids(engine, [1], workers = 1))
+    assert asked[2:] == [False] # still within STATS_CHECK_INTERVAL
+
+    monkeypatch.setattr(cutouts, "STATS_CHECK_INTERVAL", 0)
+    list(stream_candids(engine, [1], workers = 1))
+    assert asked[3:] == [True]
+    with engine.connect() as con:
+        assert con.exec_driver_sql("SELECT count(*) FROM cutout_stats").scalar() == 1
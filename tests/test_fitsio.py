@@ -0,0 +1,77 @@
+from io import BytesIO
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from utils import fitsio
+from utils.fitsio import BITPIX_DTYPES, UnsupportedFITS, read_image
+
+
+def make_fits(data, bitpix, **cards):
+    """Raw bytes of a primary HDU holding `data` as stored values (no scaling applied)."""
+    header = fits.Header([("SIMPLE", True), ("BITPIX", bitpix), ("NAXIS", data.ndim)] +
+                         [(f"NAXIS{k + 1}", n) for k, n in enumerate(reversed(data.shape))] + list(cards.items()))
+    raw = header.tostring().encode("ascii") + data.astype(BITPIX_DTYPES[bitpix]).tobytes()
+    return raw + b"\0" * (-len(raw) % fitsio.BLOCK)
+
+
+def same_type(a, b):
+    # byte order aside: astropy keeps big endian floats where the fast path may return native ones
+    return a.dtype.kind == b.dtype.kind and a.dtype.itemsize == b.dtype.itemsize
+
+
+def astropy_image(raw):
+    with fits.open(BytesIO(raw)) as hdul:
+        return hdul[0].data.copy()
+
+
+def stored(bitpix, shape = (7, 5), seed = 0):
+    rng = np.random.default_rng(seed)
+    if bitpix < 0:
+        return rng.normal(0, 1e3, shape)
+    info = np.iinfo(BITPIX_DTYPES[bitpix])
+    return rng.integers(max(info.min, -2**20), min(info.max, 2**20), shape)
+
+
+@pytest.mark.parametrize("bitpix", sorted(BITPIX_DTYPES))
+@pytest.mark.parametrize("scaling", [{}, {"BSCALE": 2.5}, {"BZERO": 10.0}, {"BSCALE": 0.25, "BZERO": -3.0}])
+def test_matches_astropy(bitpix, scaling):
+    raw = make_fits(stored(bitpix), bitpix, **scaling)
+    fast = fitsio._read_fast(raw) # the fast path is taken, not the fallback
+    expected = astropy_image(raw)
+
+    assert fast.shape == expected.shape
+    assert same_type(fast, expected)
+    np.testing.assert_array_equal(fast, expected)
+    np.testing.assert_array_equal(read_image(raw), expected)
+
+
+@pytest.mark.parametrize("raw", [
+    make_fits(stored(-32, (2, 3, 4)), -32), # NAXIS = 3
+    make_fits(stored(16), 16, BLANK = -32768),
+    make_fits(stored(16), 16, BZERO = 32768), # unsigned 16 bit convention
+    make_fits(stored(8), 8, BZERO = -128), # signed byte convention
+], ids = ["naxis3", "blank", "uint16", "int8"])
+def test_falls_back_to_astropy(raw):
+    with pytest.raises(UnsupportedFITS):
+        fitsio._read_fast(raw)
+    expected = astropy_image(raw)
+    result = read_image(raw)
+    assert same_type(result, expected)
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_truncated_data_falls_back(monkeypatch):
+    raw = make_fits(stored(-64, (40, 40)), -64)
+    truncated = raw[:fitsio.BLOCK + 100]
+    with pytest.raises(UnsupportedFITS):
+        fitsio._read_fast(truncated)
+
+    calls = []
+    def fake_open(buf):
+        calls.append(buf)
+        return [fits.PrimaryHDU(np.zeros((2, 2)))]
+    monkeypatch.setattr(fitsio.fits, "open", fake_open)
+    read_image(truncated)
+    assert len(calls) == 1
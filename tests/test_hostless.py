@@ -0,0 +1,81 @@
+import threading
+
+import numpy as np
+import pytest
+from sqlalchemy import create_engine, text
+
+from utils import hostless
+from utils.hostless import ScanCache, hostless_params, scan
+
+
+def candidate(candid, epochid, rbscore = 0.9):
+    return {"candid": candid, "epochid": epochid, "field": 1, "rbscore": rbscore, "nmatches": 3, "scorr_peak": 20,
+            "ispos": 1, "mjd": 100.0, "firstdet": 50.0, "wdist1": 20, "wdist2": 20, "wdist3": 20,
+            "w1mag1": 12, "w1mag2": 12, "w1mag3": 12, "distnearbrstar": 20}
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    monkeypatch.setattr(hostless, "_eligible_epochs", (None, frozenset()))
+    engine = create_engine(f"sqlite:///{tmp_path / 'hostless.db'}")
+    row = candidate(0, 0)
+    with engine.begin() as con:
+        con.execute(text(f"CREATE TABLE candidates ({', '.join(row)})"))
+        con.execute(text("CREATE TABLE fields (field, gallat)"))
+        con.execute(text("CREATE TABLE classifications (candid)"))
+        con.execute(text(f"CREATE TABLE {hostless.ELIGIBLE_TABLE} (candid, epochid, abs_gallat, rbscore)"))
+        con.execute(text(f"CREATE TABLE {hostless.EPOCHS_TABLE} (epochid PRIMARY KEY, refreshed_at)"))
+        con.execute(text("INSERT INTO fields VALUES (1, -30.0)"))
+        con.execute(text(f"INSERT INTO candidates VALUES ({', '.join(':' + k for k in row)})"),
+                    [candidate(1, 8), candidate(2, 9)])
+        # rows that only the eligible table has, so the results show which source was scanned
+        con.execute(text(f"INSERT INTO {hostless.ELIGIBLE_TABLE} VALUES (11, 8, 30.0, 0.9), (12, 9, 30.0, 0.9)"))
+    return engine
+
+
+def scanned(engine, epoch):
+    return scan(engine, hostless_params(epoch, 0, 90), 10).tolist()
+
+
+def test_unrefreshed_epochs_scan_candidates(engine, monkeypatch):
+    assert scanned(engine, 8) == [1] and scanned(engine, 9) == [2]
+
+    with engine.begin() as con:
+        con.execute(text(f"INSERT INTO {hostless.EPOCHS_TABLE} VALUES (8, '2026-01-01')"))
+    assert scanned(engine, 8) == [1] # the recorded epochs are trusted for ELIGIBLE_CHECK_INTERVAL
+
+    monkeypatch.setattr(hostless, "ELIGIBLE_CHECK_INTERVAL", 0)
+    assert scanned(engine, 8) == [11] and scanned(engine, 9) == [2]
+
+
+def test_bounds_that_share_a_cache_key_scan_the_same(engine):
+    with engine.begin() as con:
+        con.execute(text("UPDATE fields SET gallat = 30.003"))
+    low, high = hostless_params(8, 30.001, 90), hostless_params(8, 30.004, 90)
+    assert hostless.scan_key(low, 10) == hostless.scan_key(high, 10)
+    assert scan(engine, low, 10).tolist() == scan(engine, high, 10).tolist() == [1]
+
+
+def test_waiting_for_a_shared_scan_does_not_use_run(monkeypatch):
+    started, release, runs = threading.Event(), threading.Event(), []
+
+    def slow_scan(engine, params, limit, handle = None):
+        started.set()
+        release.wait(5)
+        return np.arange(limit)
+
+    def run(fn):
+        runs.append(threading.current_thread().name)
+        return fn(None)
+
+    monkeypatch.setattr(hostless, "scan", slow_scan)
+    cache, params = ScanCache(), hostless_params(8, 0, 90)
+    results = []
+    first = threading.Thread(target = lambda: results.append(cache.load(None, params, 3, run = run)), name = "first")
+    second = threading.Thread(target = lambda: results.append(cache.load(None, params, 3, run = run)), name = "second")
+    first.start()
+    assert started.wait(5)
+    second.start()
+    release.set()
+    first.join(5), second.join(5)
+    assert runs == ["first"] and [r.tolist() for r in results] == [[0, 1, 2]] * 2
@@ -0,0 +1,25 @@
+import os
+
+from utils.png_cache import PngCache
+
+
+def test_disk_tier_keeps_to_its_budget(tmp_path):
+    cache = PngCache(max_bytes = 1000, path = str(tmp_path), max_disk_bytes = 25)
+    for candid in range(3):
+        cache.put((candid, "sci"), bytes(10))
+    assert len(os.listdir(tmp_path)) == 2 and cache.disk_nbytes == 20
+    assert not os.path.exists(cache._file((0, "sci")))
+
+    cache.put((1, "sci"), bytes(10)) # rewriting a file doesn't count it twice
+    assert cache.disk_nbytes == 20 and len(os.listdir(tmp_path)) == 2
+
+
+def test_disk_budget_counts_files_from_before_a_restart(tmp_path):
+    cache = PngCache(max_bytes = 1000, path = str(tmp_path), max_disk_bytes = 100)
+    for candid in range(3):
+        cache.put((candid, "sci"), bytes(10))
+
+    restarted = PngCache(max_bytes = 1000, path = str(tmp_path), max_disk_bytes = 15)
+    assert restarted.disk_nbytes == 10 and len(os.listdir(tmp_path)) == 1
+    restarted.put((3, "sci"), bytes(10))
+    assert restarted.get((3, "sci")) == bytes(10) and len(os.listdir(tmp_path)) == 1
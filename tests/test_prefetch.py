@@ -0,0 +1,47 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from utils import prefetch
+from utils.prefetch import Prefetcher
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    # one thread, like a pool that other sessions' jobs are holding up
+    executor = ThreadPoolExecutor(max_workers = 1)
+    monkeypatch.setattr(prefetch, "_executor", executor)
+    yield executor
+    executor.shutdown(wait = True, cancel_futures = True)
+
+
+def test_wait_does_not_block_behind_queued_jobs(pool, monkeypatch):
+    release, ran = threading.Event(), []
+    pool.submit(release.wait, 5) # another session's job
+    monkeypatch.setattr(prefetch, "prefetch_candids", lambda engine, candids, cancelled, store: ran.append(candids))
+
+    prefetcher = Prefetcher(None, store = object())
+    prefetcher.prefetch({2: [20], 3: [30]})
+    prefetcher.wait(2)
+    assert prefetcher._jobs == {}
+    release.set()
+    pool.shutdown(wait = True)
+    assert ran == []
+
+
+def test_wait_reuses_a_running_job(pool, monkeypatch):
+    started, release, done = threading.Event(), threading.Event(), []
+
+    def fetch(engine, candids, cancelled, store):
+        started.set()
+        release.wait(5)
+        done.append(candids)
+    monkeypatch.setattr(prefetch, "prefetch_candids", fetch)
+
+    prefetcher = Prefetcher(None, store = object())
+    prefetcher.prefetch({2: [20]})
+    assert started.wait(5)
+    threading.Timer(0.1, release.set).start()
+    prefetcher.wait(2)
+    assert done == [[20]]
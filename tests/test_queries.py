@@ -0,0 +1,38 @@
+import threading
+
+from utils import queries
+from utils.queries import QueryHandle
+
+
+def test_backend_is_not_released_while_it_is_being_cancelled(monkeypatch):
+    cancelling, release, cancelled = threading.Event(), threading.Event(), []
+
+    def cancel_backend(engine, pid):
+        cancelling.set()
+        release.wait(5)
+        cancelled.append(pid)
+    monkeypatch.setattr(queries, "cancel_backend", cancel_backend)
+
+    handle = QueryHandle()
+    handle.pid = 123
+    canceller = threading.Thread(target = handle.cancel, args = (None,))
+    canceller.start()
+    assert cancelling.wait(5)
+
+    detached = threading.Thread(target = handle.detach)
+    detached.start()
+    detached.join(0.2)
+    assert detached.is_alive() and handle.pid == 123 # fetch keeps the connection until the cancel is done
+    release.set()
+    detached.join(5), canceller.join(5)
+    assert handle.pid is None and cancelled == [123]
+
+
+def test_cancel_after_detach_leaves_the_backend_alone(monkeypatch):
+    cancelled = []
+    monkeypatch.setattr(queries, "cancel_backend", lambda engine, pid: cancelled.append(pid))
+    handle = QueryHandle()
+    handle.pid = 123
+    handle.detach()
+    handle.cancel(None)
+    assert cancelled == [] and handle.cancelled.is_set()
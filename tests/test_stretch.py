@@ -0,0 +1,48 @@
+import warnings
+
+import numpy as np
+import pytest
+from astropy.stats import sigma_clipped_stats
+
+from utils.cutouts import clipped_median_std
+
+
+def images():
+    rng = np.random.default_rng(0)
+    noise = rng.normal(100, 10, (63, 63))
+    with_nan = noise.copy()
+    with_nan[5:20, 10:30] = np.nan
+    bimodal = np.where(rng.random((63, 63)) < 0.7, rng.normal(50, 5, (63, 63)), rng.normal(400, 20, (63, 63)))
+    outliers = noise.copy()
+    outliers[rng.integers(0, 63, 40), rng.integers(0, 63, 40)] = 1e6
+    outliers[0, :5] = -1e5
+    with_inf = noise.copy()
+    with_inf[3, 3] = np.inf
+    return {"noise": noise, "nan": with_nan, "constant": np.full((63, 63), 7.5), "bimodal": bimodal,
+            "outliers": outliers, "inf": with_inf, "edge": np.pad(noise[:40], ((0, 23), (0, 0)), constant_values = np.nan)}
+
+
+@pytest.mark.parametrize("name", list(images()))
+def test_matches_sigma_clipped_stats(name):
+    img = images()[name]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        _, expected_median, expected_std = sigma_clipped_stats(img)
+    median, std = clipped_median_std(img[None, None])
+
+    np.testing.assert_allclose(median[0, 0], expected_median, rtol = 1e-6, atol = 1e-9)
+    np.testing.assert_allclose(std[0, 0], expected_std, rtol = 1e-6, atol = 1e-9)
+
+
+def test_batched_matches_one_at_a_time():
+    stack = np.stack(list(images().values()))[:, None].repeat(3, axis = 1).astype(np.float32)
+    median, std = clipped_median_std(stack)
+    for i in range(len(stack)):
+        m, s = clipped_median_std(stack[i:i + 1, :1])
+        np.testing.assert_array_equal(median[i, 0], m[0, 0])
+        np.testing.assert_array_equal(std[i, 0], s[0, 0])
+
+
+def test_all_nan_gives_nan():
+    median, std = clipped_median_std(np.full((1, 1, 4, 4), np.nan))
+    assert np.isnan(median).all() and np.isnan(std).all()
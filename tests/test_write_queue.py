@@ -0,0 +1,67 @@
+import time
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+from utils.db import LABEL_TABLES
+from utils.write_queue import WriteQueue
+
+LABEL = LABEL_TABLES[0]
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'labels.db'}")
+    with engine.begin() as con:
+        con.execute(text("CREATE TABLE classifications (id integer PRIMARY KEY, candid bigint NOT NULL UNIQUE, "
+                         "label text NOT NULL, CHECK (candid > 0))"))
+    return engine
+
+
+def stored(engine):
+    with engine.connect() as con:
+        return sorted(con.execute(text("SELECT candid FROM classifications")).scalars())
+
+
+def test_bad_write_is_not_retried(engine):
+    writes = WriteQueue(engine, retries = 5, delay = 10)
+    started = time.monotonic()
+    for candid in (1, -1, 2):
+        writes.classify(candid, LABEL, replace = False)
+    assert writes.flush(timeout = 5)
+    assert time.monotonic() - started < 5
+    assert stored(engine) == [1, 2]
+    assert [(candid, label) for candid, label, _ in writes.failed()] == [(-1, LABEL)]
+
+
+def test_unreachable_server_is_retried(engine, monkeypatch):
+    connect, refused = engine.connect, []
+
+    def flaky_connect():
+        if len(refused) < 2:
+            refused.append(1)
+            raise OperationalError("connect", {}, Exception("connection refused"))
+        return connect()
+
+    monkeypatch.setattr(engine, "connect", flaky_connect)
+    writes = WriteQueue(engine, retries = 5, delay = 0.01)
+    writes.classify(1, LABEL, replace = False)
+    writes.classify(2, LABEL, replace = False)
+    assert writes.flush(timeout = 5)
+    assert len(refused) == 2 and stored(engine) == [1, 2] and writes.failed() == []
+
+
+def test_unreachable_server_gives_up_once(engine, monkeypatch):
+    attempts = []
+
+    def refuse():
+        attempts.append(1)
+        raise OperationalError("connect", {}, Exception("connection refused"))
+
+    monkeypatch.setattr(engine, "connect", refuse)
+    writes = WriteQueue(engine, retries = 2, delay = 0.01)
+    writes.classify(1, LABEL, replace = False)
+    writes.classify(2, LABEL, replace = False)
+    assert writes.flush(timeout = 5)
+    assert len(attempts) <= 6 and sorted(candid for candid, _, _ in writes.failed()) == [1, 2]
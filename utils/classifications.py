@@ -0,0 +1,102 @@
+"""All labels in one classifications table, one row per candid.
+
+The old per-label tables are kept (renamed to <label>_legacy) and views with
+their names and columns (reals.realsid, reals.candid, ...) are put in their
+place, so read queries keep working. Writes go through classify() and
+unclassify(). To move an existing database over, once:
+
+    python -m utils.classifications --migrate
+
+(--print shows the SQL instead of running it.)
+"""
+import argparse
+
+from sqlalchemy import text
+
+from utils.db import LABEL_TABLES, make_engine
+
+TABLE = "classifications"
+CONFLICTS_TABLE = "classification_conflicts"
+
+CREATE_TABLE = f"""
+    CREATE TABLE IF NOT EXISTS {TABLE} (
+        id bigint GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+        candid bigint NOT NULL UNIQUE,
+        label text NOT NULL CHECK (label IN ({", ".join(f"'{label}'" for label in LABEL_TABLES)})),
+        classified_at timestamptz NOT NULL DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS {TABLE}_label_id ON {TABLE} (label, id);"""
+
+_LEGACY_ROWS = " UNION ALL ".join(f"SELECT candid, '{label}' AS label, {k} AS k, {label}id AS old_id FROM {label}"
+                                  for k, label in enumerate(LABEL_TABLES))
+
+MIGRATION = f"""
+{CREATE_TABLE}
+
+-- candids that are in more than one table keep the first label in {LABEL_TABLES} order, the rest are listed here
+CREATE TABLE {CONFLICTS_TABLE} AS
+    SELECT candid, array_agg(DISTINCT label) AS labels FROM ({_LEGACY_ROWS}) l
+    GROUP BY candid HAVING count(DISTINCT label) > 1;
+
+-- ids are handed out label by label in the old id order, so the review pages keep their order
+INSERT INTO {TABLE} (candid, label)
+    SELECT candid, label FROM (
+        SELECT DISTINCT ON (candid) candid, label, k, old_id FROM ({_LEGACY_ROWS}) l ORDER BY candid, k, old_id
+    ) d ORDER BY k, old_id;
+
+{"".join(f'''
+ALTER TABLE {label} RENAME TO {label}_legacy;
+CREATE VIEW {label} AS SELECT id AS {label}id, candid FROM {TABLE} WHERE label = '{label}';''' for label in LABEL_TABLES)}
+"""
+
+UPSERT = text(f"""
+    INSERT INTO {TABLE} (candid, label) VALUES (:candid, :label)
+    ON CONFLICT (candid) DO UPDATE SET label = EXCLUDED.label, classified_at = now();""")
+INSERT_NEW = text(f"INSERT INTO {TABLE} (candid, label) VALUES (:candid, :label) ON CONFLICT (candid) DO NOTHING;")
+DELETE = text(f"DELETE FROM {TABLE} WHERE candid = :candid;")
+DELETE_LABEL = text(f"DELETE FROM {TABLE} WHERE candid = :candid AND label = :label;")
+
+
+def classify_statement(candid, label, replace = True):
+    """(statement, params) that labels a candidate; with replace = False an existing label is kept."""
+    if label not in LABEL_TABLES:
+        raise ValueError(f"label must be one of {LABEL_TABLES}, not {label!r}")
+    return (UPSERT if replace else INSERT_NEW), {"candid": int(candid), "label": label}
+
+
+def unclassify_statement(candid, label = None):
+    """(statement, params) that removes a candidate's label (only if it is `label`, when given)."""
+    if label is None:
+        return DELETE, {"candid": int(candid)}
+    return DELETE_LABEL, {"candid": int(candid), "label": label}
+
+
+def classify(engine, candid, label, replace = True):
+    """Label a candidate, replacing any label it had: one round trip."""
+    with engine.begin() as con:
+        con.execute(*classify_statement(candid, label, replace))
+
+
+def unclassify(engine, candid, label = None):
+    """Remove a candidate's label (only if it is `label`, when given)."""
+    with engine.begin() as con:
+        con.execute(*unclassify_statement(candid, label))
+
+
+def migrate(engine):
+    """Run MIGRATION in a single transaction."""
+    with engine.begin() as con:
+        con.exec_driver_sql(MIGRATION)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Move the label tables into one classifications table.")
+    parser.add_argument("--migrate", action = "store_true", help = "run the migration")
+    parser.add_argument("--print", action = "store_true", help = "print the migration SQL")
+    args = parser.parse_args()
+
+    if args.print:
+        print(f"BEGIN;{MIGRATION}COMMIT;")
+    if args.migrate:
+        migrate(make_engine())
+        print("Migrated the label tables to classifications.")
@@ -0,0 +1,94 @@
+import time
+import threading
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from utils.classifications import TABLE
+
+REFRESH_INTERVAL = 5 # seconds, a lookup within this long of the last refresh doesn't touch the database
+
+_default = None
+_default_lock = threading.Lock()
+
+
+class ClassifiedIndex:
+    """Sorted array of every classified candid, shared by the server process.
+
+    The first refresh reads the candids of the classifications table once;
+    after that only rows above the highest id seen so far are fetched and
+    merged in. Labels removed since (unclassify) don't show up that way, so
+    the row count is checked too and the array is read again in full when
+    it doesn't match. Writes made through this process's WriteQueue are
+    applied with update() as soon as they land. Membership is a binary search, and exclude() filters
+    a whole array of candids with one searchsorted.
+    """
+
+    def __init__(self, engine, interval = REFRESH_INTERVAL):
+        self.engine = engine
+        self.interval = interval
+        self._candids = np.empty(0, dtype = np.int64)
+        self._watermark = None
+        self._refreshed = None
+        self._lock = threading.Lock()
+
+    def refresh(self, force = False):
+        """Fetch the rows added since the last refresh, unless that was less than `interval` ago."""
+        with self._lock:
+            if not force and self._refreshed is not None and time.monotonic() - self._refreshed < self.interval:
+                return
+            if self._watermark is not None:
+                new = pd.read_sql_query(text(f"SELECT id, candid FROM {TABLE} WHERE id > :after"),
+                                        self.engine, params = {"after": self._watermark})
+                count = int(pd.read_sql_query(text(f"SELECT count(*) AS n FROM {TABLE}"), self.engine).n[0])
+                candids = np.union1d(self._candids, new.candid.to_numpy(dtype = np.int64))
+                if len(candids) == count:
+                    self._candids = candids
+                    self._watermark = max(self._watermark, int(new.id.max())) if len(new) else self._watermark
+                    self._refreshed = time.monotonic()
+                    return
+            rows = pd.read_sql_query(text(f"SELECT id, candid FROM {TABLE}"), self.engine)
+            self._candids = np.unique(rows.candid.to_numpy(dtype = np.int64))
+            self._watermark = int(rows.id.max()) if len(rows) else 0
+            self._refreshed = time.monotonic()
+
+    def update(self, added = (), removed = ()):
+        """Apply writes this process has made, so they count before the next refresh reads them back."""
+        with self._lock:
+            candids = np.union1d(self._candids, np.asarray(added, dtype = np.int64))
+            self._candids = np.setdiff1d(candids, np.asarray(removed, dtype = np.int64))
+
+    def _current(self):
+        self.refresh()
+        return self._candids
+
+    def __contains__(self, candid):
+        candids = self._current()
+        i = np.searchsorted(candids, int(candid))
+        return bool(i < len(candids) and candids[i] == int(candid))
+
+    def isin(self, candids):
+        """Boolean mask of the entries of `candids` that are classified."""
+        classified = self._current()
+        candids = np.asarray(candids, dtype = np.int64)
+        if len(classified) == 0:
+            return np.zeros(candids.shape, dtype = bool)
+        i = np.searchsorted(classified, candids).clip(max = len(classified) - 1)
+        return classified[i] == candids
+
+    def exclude(self, candids):
+        """`candids` without the classified ones, order kept."""
+        candids = np.asarray(candids, dtype = np.int64)
+        return candids[~self.isin(candids)]
+
+    def __len__(self):
+        return len(self._current())
+
+
+def default_index(engine):
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = ClassifiedIndex(engine)
+        return _default
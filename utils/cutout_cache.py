@@ -0,0 +1,126 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from utils.cutouts import Cutouts, QUANTIZE_DTYPES, load_candids, quantize
+
+# decoded float32 cutouts kept in memory per server process, least recently used go first
+CACHE_MAX_BYTES = int(float(os.environ.get("NEOWISE_CUTOUT_CACHE_BYTES", 1e9)))
+# float16 or uint8 (display levels) fit 2x or 4x more cutouts in the same budget
+CACHE_DTYPE = os.environ.get("NEOWISE_CUTOUT_CACHE_DTYPE", "float32")
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def candid_key(candids, limit = None):
+    """Cheap digest of a candid list: order and duplicates don't matter, like in load_candids."""
+    arr = np.unique(np.fromiter((int(c) for c in candids), dtype = np.int64))
+    return hashlib.blake2b(arr.tobytes(), digest_size = 16).hexdigest(), limit
+
+
+def cutouts_nbytes(cutouts):
+    return cutouts.candids.nbytes + cutouts.images.nbytes + cutouts.vmin.nbytes + cutouts.vmax.nbytes + cutouts.meta.nbytes
+
+
+def _views(cutouts):
+    return Cutouts(cutouts.candids.view(), cutouts.images.view(), cutouts.vmin.view(), cutouts.vmax.view(), cutouts.meta.view())
+
+
+def _readonly(cutouts):
+    for arr in (cutouts.candids, cutouts.images, cutouts.vmin, cutouts.vmax, cutouts.meta):
+        arr.setflags(write = False)
+    return cutouts
+
+
+class CutoutCache:
+    """Decoded cutouts shared by every session of the server process.
+
+    Entries are keyed by candid_key() and their arrays are made read-only
+    once, so a hit hands out views of the same memory instead of the
+    pickled copy st.cache_data would unpickle on every rerun. The entries
+    together stay under max_bytes: the least recently used go first, and
+    a single entry bigger than the whole budget is returned but not kept.
+    With dtype float16 or uint8 entries are stored quantized (see
+    utils.cutouts.quantize) and handed out that way.
+    """
+
+    def __init__(self, max_bytes = CACHE_MAX_BYTES, dtype = CACHE_DTYPE):
+        if dtype not in QUANTIZE_DTYPES:
+            raise ValueError(f"dtype must be one of {QUANTIZE_DTYPES}, not {dtype!r}")
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            cutouts = self._entries.get(key)
+            if cutouts is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+        return _views(cutouts)
+
+    def put(self, key, cutouts):
+        cutouts = _readonly(quantize(cutouts, self.dtype))
+        size = cutouts_nbytes(cutouts)
+        if size > self.max_bytes:
+            return cutouts
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._sizes.pop(key)
+            self._entries[key] = cutouts
+            self._sizes[key] = size
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                old, _ = self._entries.popitem(last = False)
+                self._bytes -= self._sizes.pop(old)
+        return cutouts
+
+    def load(self, engine, candids, limit = None):
+        """Cutouts for `candids` (see load_candids), read-only and shared between sessions."""
+        key = candid_key(candids, limit)
+        cutouts = self.get(key)
+        if cutouts is None:
+            cutouts = _views(self.put(key, load_candids(engine, candids, limit)))
+        return cutouts
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def footprint(self):
+        """Current size of the cache, for monitoring."""
+        with self._lock:
+            return {"entries": len(self._entries), "nbytes": self._bytes, "max_bytes": self.max_bytes, "dtype": self.dtype,
+                    "hits": self._hits, "misses": self._misses}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+
+def default_cache():
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = CutoutCache()
+        return _default
+
+
+def cached_candids(engine, candids, limit = None):
+    return default_cache().load(engine, candids, limit)
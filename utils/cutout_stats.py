@@ -0,0 +1,81 @@
+"""Precomputed display stretch (vmin/vmax for sci, ref and diff) per candid.
+
+The loaders in utils/cutouts.py read these in the same query as the blobs
+and only compute a stretch for candids that don't have a row yet, which
+they then insert here. To fill the table for the whole cutouts table:
+
+    python -m utils.cutout_stats --batch 2000
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from utils.cutouts import STATS_TABLE, STATS_COLUMNS, decode_rows
+from utils.db import make_engine
+
+CREATE_TABLE = f"""
+    CREATE TABLE IF NOT EXISTS {STATS_TABLE} (
+        candid bigint PRIMARY KEY,
+        {", ".join(f"{col} double precision" for col in STATS_COLUMNS)}
+    );"""
+
+
+def create_table(engine):
+    with engine.connect() as con:
+        con.execute(text(CREATE_TABLE))
+        con.commit()
+
+
+def save_stats(engine, candids, vmin, vmax):
+    """Insert stretch values for candids that don't have them yet."""
+    if len(candids) == 0:
+        return
+    values = np.empty((len(candids), 6))
+    values[:, 0::2] = vmin
+    values[:, 1::2] = vmax
+    rows = [dict(zip(STATS_COLUMNS, row), candid = int(candid)) for candid, row in zip(candids, values.tolist())]
+
+    query = text(f"""
+        INSERT INTO {STATS_TABLE} (candid, {", ".join(STATS_COLUMNS)})
+        VALUES (:candid, {", ".join(f":{col}" for col in STATS_COLUMNS)})
+        ON CONFLICT (candid) DO NOTHING;""")
+    with engine.connect() as con:
+        con.execute(query, rows)
+        con.commit()
+
+
+def backfill(engine, batch = 2000, workers = None, limit = None):
+    """Compute and store the stretch for every cutout that has none, in candid order."""
+    create_table(engine)
+    query = text(f"""
+        SELECT c.candid, c.sci_image, c.ref_image, c.diff_image from cutouts c
+        WHERE c.candid > :after AND NOT EXISTS (SELECT 1 FROM {STATS_TABLE} s WHERE s.candid = c.candid)
+        ORDER BY c.candid LIMIT :batch;""")
+
+    after = -1
+    done = 0
+    start = time.time()
+    while limit is None or done < limit:
+        rows = pd.read_sql_query(query, engine, params = {"after": after, "batch": batch})
+        if len(rows) == 0:
+            break
+        images, vmin, vmax = decode_rows(rows, workers)
+        save_stats(engine, rows.candid.to_numpy(), vmin, vmax)
+
+        after = int(rows.candid.iloc[-1])
+        done += len(rows)
+        print(f"{done} cutouts, last candid {after}, {done / (time.time() - start):.0f}/s", flush = True)
+    return done
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Backfill the cutout_stats table.")
+    parser.add_argument("--batch", type = int, default = 2000, help = "cutouts fetched per query")
+    parser.add_argument("--workers", type = int, default = None, help = "decode processes (default NEOWISE_DECODE_WORKERS)")
+    parser.add_argument("--limit", type = int, default = None, help = "stop after this many cutouts")
+    args = parser.parse_args()
+
+    backfill(make_engine(), args.batch, args.workers, args.limit)
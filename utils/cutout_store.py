@@ -0,0 +1,186 @@
+import os
+import threading
+import fcntl
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+
+from utils.cutouts import Cutouts, META_COLUMNS, merge_cutouts
+
+# decoded cutouts are immutable, so they are kept on local disk across restarts.
+# NEOWISE_CUTOUT_STORE="" turns the store off.
+STORE_PATH = os.environ.get("NEOWISE_CUTOUT_STORE", ".cutout_store")
+STORE_MAX_BYTES = int(float(os.environ.get("NEOWISE_CUTOUT_STORE_BYTES", 4e9)))
+# small puts (prefetch batches) are appended to the newest segment until it reaches this size
+SEGMENT_MIN_BYTES = 16 * 2**20
+
+_default = None
+_default_lock = threading.Lock()
+
+
+class CutoutStore:
+    """Append-only on-disk store of decoded cutouts keyed by candid.
+
+    Each put() writes one segment: a .npy (n, 3, H, W) float32 array that is
+    read back memory-mapped; while the newest segment is smaller than
+    SEGMENT_MIN_BYTES it is rewritten with the new rows appended instead, so
+    small puts don't leave thousands of tiny files. index.npz maps candid -> (segment, row) and
+    holds the stretch values and candidate columns. Segments and the index are written to a temp
+    file and renamed into place, so readers never need the lock and always
+    see a complete index; writers serialise on an flock. When the segments
+    outgrow max_bytes the oldest ones are dropped.
+    """
+
+    def __init__(self, path, max_bytes = STORE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok = True)
+        self._index = None
+        self._index_key = None
+        self._segments = {}
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _segment_name(self, seg):
+        return f"seg-{seg:08d}.npy"
+
+    @contextmanager
+    def _lock(self):
+        with open(self._file("lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _atomic_write(self, name, write):
+        fd, tmp = tempfile.mkstemp(dir = self.path, suffix = ".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmp, self._file(name))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def _read_index(self):
+        try:
+            stat = os.stat(self._file("index.npz"))
+        except FileNotFoundError:
+            return {"candid": np.empty(0, dtype = np.int64), "seg": np.empty(0, dtype = np.int64),
+                    "row": np.empty(0, dtype = np.int64), "vmin": np.empty((0, 3)), "vmax": np.empty((0, 3)),
+                    "meta": np.empty((0, len(META_COLUMNS)))}
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if key != self._index_key:
+            with np.load(self._file("index.npz")) as f:
+                self._index = {name: f[name] for name in f.files}
+            if "meta" not in self._index: # stores written before the candidate columns were kept
+                self._index["meta"] = np.full((len(self._index["candid"]), len(META_COLUMNS)), np.nan)
+            self._index_key = key
+        return self._index
+
+    def _write_index(self, index):
+        self._atomic_write("index.npz", lambda f: np.savez(f, **index))
+
+    def _segment(self, seg):
+        # segments are replaced, never modified in place: a new inode means the mapping is stale
+        path = self._file(self._segment_name(seg))
+        inode = os.stat(path).st_ino
+        cached = self._segments.get(seg)
+        if cached is None or cached[0] != inode:
+            cached = self._segments[seg] = (inode, np.load(path, mmap_mode = "r"))
+        return cached[1]
+
+    def get(self, candids):
+        """Stored cutouts among `candids` (sorted by candid) and the candids that are missing."""
+        candids = np.unique(np.asarray(candids, dtype = np.int64))
+        index = self._read_index()
+        pos = np.searchsorted(index["candid"], candids)
+        pos = np.minimum(pos, max(len(index["candid"]) - 1, 0))
+        hit = (index["candid"][pos] == candids) if len(index["candid"]) else np.zeros(len(candids), dtype = bool)
+
+        parts = []
+        missing = [candids[~hit]]
+        for seg in np.unique(index["seg"][pos[hit]]):
+            sel = pos[hit][index["seg"][pos[hit]] == seg]
+            try:
+                images = np.ascontiguousarray(self._segment(seg)[index["row"][sel]])
+            except FileNotFoundError: # evicted since the index was read
+                self._segments.pop(seg, None)
+                missing.append(index["candid"][sel])
+                continue
+            parts.append(Cutouts(index["candid"][sel], images, index["vmin"][sel], index["vmax"][sel], index["meta"][sel]))
+        return merge_cutouts(parts), np.sort(np.concatenate(missing))
+
+    def put(self, cutouts):
+        if len(cutouts) == 0:
+            return
+        with self._lock():
+            index = self._read_index()
+            new = ~np.isin(cutouts.candids, index["candid"])
+            if not new.any():
+                return
+            candids = np.asarray(cutouts.candids[new], dtype = np.int64)
+            images = np.ascontiguousarray(cutouts.images[new], dtype = np.float32)
+
+            seg = int(index["seg"].max()) + 1 if len(index["seg"]) else 0
+            start = 0
+            if seg > 0:
+                last = self._file(self._segment_name(seg - 1))
+                if os.path.getsize(last) < SEGMENT_MIN_BYTES:
+                    old = np.load(last, mmap_mode = "r")
+                    if old.shape[1:] == images.shape[1:]:
+                        # rows already in the segment keep their numbers, readers of the old index still find them
+                        seg, start = seg - 1, len(old)
+                        images = np.concatenate([old, images])
+            self._atomic_write(self._segment_name(seg), lambda f: np.save(f, images))
+
+            index = {
+                "candid": np.concatenate([index["candid"], candids]),
+                "seg": np.concatenate([index["seg"], np.full(len(candids), seg)]),
+                "row": np.concatenate([index["row"], np.arange(start, start + len(candids))]),
+                "vmin": np.concatenate([index["vmin"], cutouts.vmin[new]]),
+                "vmax": np.concatenate([index["vmax"], cutouts.vmax[new]]),
+                "meta": np.concatenate([index["meta"], cutouts.meta[new]]),
+            }
+            order = np.argsort(index["candid"], kind = "stable")
+            index = {name: arr[order] for name, arr in index.items()}
+            index = self._evict(index)
+            self._write_index(index)
+
+    def _evict(self, index):
+        segs = sorted(set(index["seg"].tolist()))
+        sizes = {seg: os.path.getsize(self._file(self._segment_name(seg))) for seg in segs}
+        total = sum(sizes.values())
+        dropped = []
+        while total > self.max_bytes and len(segs) > 1:
+            seg = segs.pop(0)
+            total -= sizes[seg]
+            dropped.append(seg)
+        if not dropped:
+            return index
+
+        keep = ~np.isin(index["seg"], dropped)
+        index = {name: arr[keep] for name, arr in index.items()}
+        # the new index has to land before the files go, readers may still map them
+        self._write_index(index)
+        for seg in dropped:
+            self._segments.pop(seg, None)
+            os.unlink(self._file(self._segment_name(seg)))
+        return index
+
+    def nbytes(self):
+        index = self._read_index()
+        return sum(os.path.getsize(self._file(self._segment_name(seg))) for seg in np.unique(index["seg"]))
+
+
+def default_store():
+    global _default
+    if not STORE_PATH:
+        return None
+    with _default_lock:
+        if _default is None:
+            _default = CutoutStore(STORE_PATH)
+        return _default
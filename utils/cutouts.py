@@ -0,0 +1,478 @@
+import os
+import gzip
+import time
+import threading
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text, bindparam
+from sqlalchemy.exc import ProgrammingError
+
+from utils.fitsio import read_image
+from utils.queries import QUERY_TIMEOUT_MS, set_timeout
+
+BANDS = ("sci", "ref", "diff")
+# per-candidate columns of the candidates table that come back with the cutouts
+META_COLUMNS = ("ra", "dec", "rbscore", "epochid")
+
+# display stretch: vmin = median - lowp*std, vmax = median + highp*std
+LOWP = 1
+HIGHP = 5
+
+# process pool used to decode large queries, set NEOWISE_DECODE_WORKERS=1 to decode serially
+DECODE_WORKERS = int(os.environ.get("NEOWISE_DECODE_WORKERS", os.cpu_count() or 1))
+DECODE_CHUNKSIZE = 64 # triplets per task
+PARALLEL_MIN_ROWS = 256 # below this, pool overhead outweighs the speedup
+
+_pool = None
+_pool_workers = None
+_pool_lock = threading.Lock()
+
+# rows pulled per round trip from the server-side cursor when streaming cutouts
+FETCH_BATCH = 512
+
+# precomputed stretch values per candid, filled by utils/cutout_stats.py
+STATS_TABLE = "cutout_stats"
+STATS_COLUMNS = ("sci_vmin", "sci_vmax", "ref_vmin", "ref_vmax", "diff_vmin", "diff_vmax")
+STATS_CHECK_INTERVAL = 60 # seconds, how long a missing cutout_stats table is trusted to stay missing
+_has_stats_table = None
+_stats_missing_at = None
+
+
+@dataclass
+class Cutouts:
+    """Decoded sci/ref/diff triplets for a set of candidates.
+
+    images is one contiguous (N, 3, H, W) float32 array, vmin/vmax are (N, 3)
+    and row i of every array belongs to candids[i]. Copies held in memory
+    caches may be float16 or uint8 display levels instead, see quantize().
+    meta is (N, len(META_COLUMNS)) float64, nan where unknown.
+    """
+    candids: np.ndarray
+    images: np.ndarray
+    vmin: np.ndarray
+    vmax: np.ndarray
+    meta: np.ndarray = None
+
+    def __post_init__(self):
+        if self.meta is None:
+            self.meta = np.full((len(self.candids), len(META_COLUMNS)), np.nan)
+
+    def __len__(self):
+        return len(self.candids)
+
+    def select(self, rows):
+        """The cutouts at `rows` (an index, slice or mask) as a new Cutouts."""
+        return Cutouts(self.candids[rows], self.images[rows], self.vmin[rows], self.vmax[rows], self.meta[rows])
+
+    @property
+    def sci(self):
+        return self.images[:, 0]
+
+    @property
+    def ref(self):
+        return self.images[:, 1]
+
+    @property
+    def diff(self):
+        return self.images[:, 2]
+
+    def unpack(self):
+        return self.candids, self.sci, self.ref, self.diff, self.vmin, self.vmax
+
+    @property
+    def ra(self):
+        return self.meta[:, 0]
+
+    @property
+    def dec(self):
+        return self.meta[:, 1]
+
+    @property
+    def rbscore(self):
+        return self.meta[:, 2]
+
+    @property
+    def epochid(self):
+        return self.meta[:, 3]
+
+    @property
+    def index(self):
+        # candid -> row
+        return {candid: i for i, candid in enumerate(self.candids.tolist())}
+
+
+def empty_cutouts():
+    return Cutouts(np.empty(0, dtype = np.int64), np.empty((0, 3, 0, 0), dtype = np.float32),
+                   np.empty((0, 3)), np.empty((0, 3)))
+
+
+def merge_cutouts(parts):
+    """Concatenate Cutouts into one, sorted by candid; smaller cutouts are nan padded."""
+    parts = [part for part in parts if len(part)]
+    if len(parts) == 0:
+        return empty_cutouts()
+
+    n = sum(len(part) for part in parts)
+    h = max(part.images.shape[2] for part in parts)
+    w = max(part.images.shape[3] for part in parts)
+    images = np.full((n, 3, h, w), np.nan, dtype = np.float32)
+    start = 0
+    for part in parts:
+        stop = start + len(part)
+        images[start:stop, :, :part.images.shape[2], :part.images.shape[3]] = part.images
+        start = stop
+
+    candids = np.concatenate([part.candids for part in parts])
+    order = np.argsort(candids, kind = "stable")
+    return Cutouts(candids[order], images[order],
+                   np.concatenate([part.vmin for part in parts])[order],
+                   np.concatenate([part.vmax for part in parts])[order],
+                   np.concatenate([part.meta for part in parts])[order])
+
+
+def decode_cutout(blob):
+    return np.flipud(read_image(gzip.decompress(blob)))
+
+
+def _decode_triplets(triplets):
+    images = [[decode_cutout(blob) for blob in triplet] for triplet in triplets]
+    if len(images) == 0:
+        return np.empty((0, 3, 0, 0), dtype = np.float32)
+
+    # cutouts near the detector edge can be smaller than the rest, size the stack for the largest and nan pad
+    h = max(img.shape[0] for triplet in images for img in triplet)
+    w = max(img.shape[1] for triplet in images for img in triplet)
+    stack = np.full((len(images), 3, h, w), np.nan, dtype = np.float32)
+    for i, triplet in enumerate(images):
+        for j, img in enumerate(triplet):
+            stack[i, j, :img.shape[0], :img.shape[1]] = img
+    return stack
+
+
+def _decode_chunk(chunk):
+    # runs in a pool worker: decode one chunk and stretch the rows in `need`, ship back arrays only
+    triplets, need = chunk
+    stack = _decode_triplets(triplets)
+    vmin = np.full((len(stack), 3), np.nan)
+    vmax = np.full((len(stack), 3), np.nan)
+    if need.any():
+        vmin[need], vmax[need] = display_limits(stack[need])
+    return stack, vmin, vmax
+
+
+def _get_pool(workers):
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait = False, cancel_futures = True)
+            # spawn rather than fork, the streamlit server process is multithreaded
+            _pool = ProcessPoolExecutor(max_workers = workers, mp_context = mp.get_context("spawn"))
+            _pool_workers = workers
+        return _pool
+
+
+def decode_rows(rows, workers = None, chunksize = None, need = None):
+    """Decode and stretch the blob columns of a cutouts query.
+
+    Returns the (N, 3, H, W) stack and the (N, 3) vmin/vmax arrays, in row
+    order. Only rows flagged in `need` (default all) get a stretch, the rest
+    are left nan. Large queries are split into chunks of triplets and fanned
+    out over a process pool of `workers` processes (NEOWISE_DECODE_WORKERS).
+    """
+    workers = DECODE_WORKERS if workers is None else workers
+    chunksize = DECODE_CHUNKSIZE if chunksize is None else chunksize
+    # psycopg2 hands bytea back as memoryview, which can't be pickled to a worker
+    triplets = [(bytes(sci), bytes(ref), bytes(diff)) for sci, ref, diff in zip(rows.sci_image, rows.ref_image, rows.diff_image)]
+    n = len(triplets)
+    need = np.ones(n, dtype = bool) if need is None else np.asarray(need, dtype = bool)
+
+    if workers <= 1 or n < PARALLEL_MIN_ROWS:
+        return _decode_chunk((triplets, need))
+
+    chunks = [(triplets[k:k + chunksize], need[k:k + chunksize]) for k in range(0, n, chunksize)]
+    results = list(_get_pool(workers).map(_decode_chunk, chunks))
+
+    # chunks are sized by their own largest cutout, pad them all to the largest overall
+    h = max(chunk_stack.shape[2] for chunk_stack, _, _ in results)
+    w = max(chunk_stack.shape[3] for chunk_stack, _, _ in results)
+    stack = np.full((n, 3, h, w), np.nan, dtype = np.float32)
+    vmin = np.empty((n, 3))
+    vmax = np.empty((n, 3))
+    start = 0
+    for chunk_stack, chunk_vmin, chunk_vmax in results:
+        stop = start + len(chunk_stack)
+        stack[start:stop, :, :chunk_stack.shape[2], :chunk_stack.shape[3]] = chunk_stack
+        vmin[start:stop] = chunk_vmin
+        vmax[start:stop] = chunk_vmax
+        start = stop
+    return stack, vmin, vmax
+
+
+def clipped_median_std(stack, sigma = 3.0, maxiters = 5):
+    """Batched sigma_clipped_stats median/std over the last two axes.
+
+    Same iteration as astropy's default (median/std, 3 sigma, 5 iterations,
+    stop once nothing more is clipped), done for every image at once. Each
+    image is sorted a single time: clipping only ever trims the tails, so
+    the surviving pixels are the slice [lo, hi) of the sorted image and
+    median/std come from that slice and running sums.
+    """
+    lead = stack.shape[:-2]
+    x = stack.reshape(-1, stack.shape[-2] * stack.shape[-1]).astype(np.float64)
+    x[np.isinf(x)] = np.nan # infs are dropped like astropy does, nans sort last
+    x.sort(axis = 1)
+    rows = np.arange(len(x))
+
+    lo = np.zeros(len(x), dtype = np.int64)
+    hi = np.sum(~np.isnan(x), axis = 1)
+    # shift by a rough centre before summing squares to keep the variance well conditioned
+    shift = x[rows, np.maximum(hi - 1, 0) // 2][:, None]
+    y = np.nan_to_num(x - shift)
+    csum = np.concatenate([np.zeros((len(x), 1)), np.cumsum(y, axis = 1)], axis = 1)
+    csq = np.concatenate([np.zeros((len(x), 1)), np.cumsum(y * y, axis = 1)], axis = 1)
+
+    def stats(lo, hi):
+        n = hi - lo
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            a = x[rows, np.minimum(lo + (n - 1) // 2, x.shape[1] - 1)]
+            b = x[rows, np.minimum(lo + n // 2, x.shape[1] - 1)]
+            median = np.where(n > 0, (a + b) / 2, np.nan)
+            mean = (csum[rows, hi] - csum[rows, lo]) / n
+            var = (csq[rows, hi] - csq[rows, lo]) / n - mean ** 2
+            std = np.where(n > 0, np.sqrt(np.maximum(var, 0)), np.nan)
+        return median, std
+
+    for _ in range(maxiters):
+        median, std = stats(lo, hi)
+        with np.errstate(invalid = "ignore"):
+            new_lo = np.maximum(lo, np.sum(x < (median - sigma * std)[:, None], axis = 1))
+            new_hi = np.minimum(hi, np.sum(x <= (median + sigma * std)[:, None], axis = 1))
+        new_hi = np.maximum(new_hi, new_lo)
+        if np.array_equal(new_lo, lo) and np.array_equal(new_hi, hi):
+            break
+        lo, hi = new_lo, new_hi
+
+    median, std = stats(lo, hi)
+    return median.reshape(lead), std.reshape(lead)
+
+
+def display_limits(stack, lowp = LOWP, highp = HIGHP):
+    """vmin/vmax of shape (N, 3) for a (N, 3, H, W) stack."""
+    if stack.shape[0] == 0:
+        return np.empty((0, 3)), np.empty((0, 3))
+    median, std = clipped_median_std(stack)
+    median = median.astype(np.float64)
+    std = std.astype(np.float64)
+    return median - lowp * std, median + highp * std
+
+
+def to_uint8(images, vmin, vmax):
+    """Grey levels 0-255 of images (..., H, W) stretched between vmin and vmax (...).
+
+    Same mapping as imshow with the gray colormap: values at or below vmin
+    are black, at or above vmax white, 256 even steps in between. nan
+    pixels (padding of edge cutouts) are black. uint8 images are taken to
+    be levels already (see quantize) and returned as they are.
+    """
+    if images.dtype == np.uint8:
+        return images
+    lo = np.asarray(vmin, dtype = np.float32)[..., None, None]
+    span = np.asarray(vmax, dtype = np.float32)[..., None, None] - lo
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        x = (images - lo) * (256 / span)
+    x = np.nan_to_num(x, nan = 0, posinf = 255, neginf = 0)
+    return np.clip(x, 0, 255).astype(np.uint8)
+
+
+QUANTIZE_DTYPES = ("float32", "float16", "uint8")
+
+
+def quantize(cutouts, dtype):
+    """Compact copy of `cutouts` for keeping in memory.
+
+    float32 leaves them as they are. float16 halves the images and keeps
+    about three significant digits (values beyond its range are clipped).
+    uint8 stores the display levels after the stretch, a quarter of the
+    size; to_uint8 hands them back unchanged, so what is shown is identical.
+    """
+    if dtype == "float32" or cutouts.images.dtype == np.dtype(dtype):
+        return cutouts
+    if dtype == "float16":
+        limit = np.finfo(np.float16).max
+        images = np.clip(cutouts.images, -limit, limit).astype(np.float16)
+    elif dtype == "uint8":
+        images = to_uint8(cutouts.images, cutouts.vmin, cutouts.vmax)
+    else:
+        raise ValueError(f"dtype must be one of {QUANTIZE_DTYPES}, not {dtype!r}")
+    return Cutouts(cutouts.candids, images, cutouts.vmin, cutouts.vmax, cutouts.meta)
+
+
+def _stored_limits(rows):
+    # stretch values that came back from cutout_stats, and which rows still need one
+    n = len(rows)
+    if not set(STATS_COLUMNS).issubset(rows.columns):
+        return np.full((n, 3), np.nan), np.full((n, 3), np.nan), np.ones(n, dtype = bool)
+    known = rows[list(STATS_COLUMNS)].to_numpy(dtype = np.float64)
+    return known[:, 0::2], known[:, 1::2], np.isnan(known).any(axis = 1)
+
+
+def to_cutouts(rows, workers = None):
+    if len(rows) == 0:
+        return empty_cutouts()
+    vmin, vmax, need = _stored_limits(rows)
+    images, new_vmin, new_vmax = decode_rows(rows, workers, need = need)
+    vmin[need] = new_vmin[need]
+    vmax[need] = new_vmax[need]
+    meta = None
+    if set(META_COLUMNS).issubset(rows.columns):
+        meta = rows[list(META_COLUMNS)].to_numpy(dtype = np.float64)
+    return Cutouts(rows.candid.to_numpy(), images, vmin, vmax, meta)
+
+
+def _default_store():
+    from utils.cutout_store import default_store
+    return default_store()
+
+
+def _cutouts_query(limit, with_stats):
+    columns = ", ".join(f"cand.{col}" for col in META_COLUMNS)
+    join = "LEFT JOIN candidates cand ON cand.candid = c.candid"
+    if with_stats:
+        columns += ", " + ", ".join(f"s.{col}" for col in STATS_COLUMNS)
+        join += f" LEFT JOIN {STATS_TABLE} s ON s.candid = c.candid"
+    query = f"""
+        SELECT c.candid, c.sci_image, c.ref_image, c.diff_image, {columns} from cutouts c {join} WHERE c.candid IN :candids ORDER BY c.candid"""
+    if limit is not None:
+        query += f" LIMIT {int(limit)}"
+    return text(query).bindparams(bindparam("candids", expanding = True))
+
+
+def fill_meta(engine, cutouts):
+    """Look up ra/dec/rbscore/epochid in one query for the rows that don't have them (in place)."""
+    missing = np.isnan(cutouts.meta).all(axis = 1)
+    if not missing.any():
+        return cutouts
+    query = text(f"SELECT candid, {', '.join(META_COLUMNS)} from candidates WHERE candid IN :candids").bindparams(
+        bindparam("candids", expanding = True))
+    rows = pd.read_sql_query(query, engine, params = {"candids": cutouts.candids[missing].tolist()})
+    rows = rows.drop_duplicates("candid").set_index("candid")
+    found = rows.reindex(cutouts.candids[missing])[list(META_COLUMNS)].to_numpy(dtype = np.float64)
+    cutouts.meta[missing] = found
+    return cutouts
+
+
+def _stream_rows(engine, candids, limit, batch):
+    # server-side cursor: only `batch` rows of blobs are held client side at a time
+    global _has_stats_table, _stats_missing_at
+    params = {"candids": candids}
+    with_stats = _has_stats_table is not False or time.monotonic() - _stats_missing_at > STATS_CHECK_INTERVAL
+    while True:
+        with engine.connect() as con:
+            try:
+                set_timeout(con, QUERY_TIMEOUT_MS)
+                result = con.execution_options(stream_results = True, max_row_buffer = batch).execute(
+                    _cutouts_query(limit, with_stats), params)
+            except ProgrammingError: # cutout_stats not created yet, see utils/cutout_stats.py
+                if not with_stats:
+                    raise
+                _has_stats_table = with_stats = False
+                _stats_missing_at = time.monotonic()
+                continue
+            if with_stats:
+                _has_stats_table = True
+            columns = list(result.keys())
+            for part in result.partitions(batch):
+                yield pd.DataFrame(part, columns = columns)
+            return
+
+
+def stream_candids(engine, candids, limit = None, batch = FETCH_BATCH, workers = None):
+    """Fetch cutouts from the database in batches of `batch` rows, in candid order.
+
+    Yields one decoded Cutouts per batch, so the raw blobs of a large query
+    are never all in memory at once. Stretch values missing from
+    cutout_stats are computed per batch and saved once the stream is
+    closed, so a stream never holds a second pooled connection.
+    """
+    candids = sorted(set(int(c) for c in candids))
+    if len(candids) == 0:
+        return
+    stream = _stream_rows(engine, candids, limit, batch)
+    new_stats = []
+    try:
+        for rows in stream:
+            cutouts = to_cutouts(rows, workers)
+            if _has_stats_table:
+                need = _stored_limits(rows)[2]
+                if need.any():
+                    new_stats.append((cutouts.candids[need], cutouts.vmin[need], cutouts.vmax[need]))
+            yield cutouts
+    finally:
+        stream.close() # gives the cursor's connection back before save_stats takes one
+        if new_stats:
+            from utils.cutout_stats import save_stats
+            save_stats(engine, *(np.concatenate(arrs) for arrs in zip(*new_stats)))
+
+
+def _fetch_candids(engine, candids, limit = None, workers = None):
+    return merge_cutouts(list(stream_candids(engine, candids, limit, workers = workers)))
+
+
+def count_rows(engine, source):
+    return int(pd.read_sql_query(f"SELECT COUNT(*) AS n from {source};", engine).n[0])
+
+
+def page_candids(engine, source, per_page, page = 1, after = None):
+    """candids of one page of a label table, by keyset pagination on {source}id.
+
+    `after` is the last id of the previous page. Without it the start of the
+    page is found by skipping (page - 1) * per_page entries of the id index.
+    Returns the page's candids and its last id (the next page's `after`).
+    """
+    idcol = f"{source}id"
+    if after is None and page > 1:
+        skipped = pd.read_sql_query(text(f"SELECT {idcol} AS id from {source} ORDER BY {idcol} LIMIT 1 OFFSET :skip"),
+                                    engine, params = {"skip": (page - 1) * per_page - 1})
+        if len(skipped) == 0:
+            return np.empty(0, dtype = np.int64), None
+        after = int(skipped.id[0])
+
+    if after is None:
+        query = text(f"SELECT {idcol} AS id, candid from {source} ORDER BY {idcol} LIMIT :n")
+    else:
+        query = text(f"SELECT {idcol} AS id, candid from {source} WHERE {idcol} > :after ORDER BY {idcol} LIMIT :n")
+    rows = pd.read_sql_query(query, engine, params = {"after": after, "n": per_page})
+    last = int(rows.id.iloc[-1]) if len(rows) else after
+    return rows.candid.to_numpy(), last
+
+
+def load_candids(engine, candids, limit = None, workers = None, store = None):
+    """Cutouts for an explicit list of candids, sorted by candid.
+
+    Candids already in the on-disk cutout store are read from it, only the
+    rest are fetched from the cutouts table and then added to the store.
+    ra/dec/rbscore/epochid come back with them (see META_COLUMNS).
+    """
+    candids = sorted(set(int(c) for c in candids))
+    if len(candids) == 0:
+        return empty_cutouts()
+
+    store = _default_store() if store is None else store
+    if not store:
+        return _fetch_candids(engine, candids, limit, workers)
+
+    stored, missing = store.get(candids)
+    parts = [stored]
+    for batch in stream_candids(engine, missing.tolist(), limit, workers = workers):
+        store.put(batch)
+        parts.append(batch)
+
+    cutouts = merge_cutouts(parts)
+    if limit is not None and len(cutouts) > limit:
+        cutouts = cutouts.select(slice(limit))
+    return fill_meta(engine, cutouts) # store entries written before meta was kept
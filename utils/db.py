@@ -0,0 +1,32 @@
+import os
+
+import streamlit as st
+from sqlalchemy import create_engine, MetaData
+
+LABEL_TABLES = ("reals", "artifact", "echo", "highpm")
+
+# one pool per server process, shared by every session and page
+POOL_SIZE = int(os.environ.get("NEOWISE_DB_POOL_SIZE", 5))
+POOL_MAX_OVERFLOW = int(os.environ.get("NEOWISE_DB_MAX_OVERFLOW", 10))
+POOL_RECYCLE = 1800 # seconds, drop connections before the server or a firewall does
+
+
+def make_engine():
+    """A new engine for the wise_db database in .streamlit/secrets.toml."""
+    db = st.secrets.wise_db
+    return create_engine(f'postgresql://{db.username}:{db.password}@{db.host}:{db.port}/{db.database}',
+                         pool_size = POOL_SIZE, max_overflow = POOL_MAX_OVERFLOW,
+                         pool_pre_ping = True, pool_recycle = POOL_RECYCLE)
+
+
+@st.cache_resource
+def get_engine():
+    return make_engine()
+
+
+@st.cache_resource
+def get_metadata():
+    """Metadata of the label tables, reflected once per process."""
+    metadata = MetaData()
+    metadata.reflect(bind = get_engine(), views = True, only = list(LABEL_TABLES))
+    return metadata
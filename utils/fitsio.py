@@ -0,0 +1,82 @@
+from io import BytesIO
+
+import numpy as np
+from astropy.io import fits
+
+BLOCK = 2880
+CARD = 80
+
+BITPIX_DTYPES = {8: ">u1", 16: ">i2", 32: ">i4", 64: ">i8", -32: ">f4", -64: ">f8"}
+# BZERO offsets astropy reads as signed bytes/unsigned ints rather than scaled floats
+UNSIGNED_BZERO = (-128, 2**15, 2**31, 2**63)
+
+
+class UnsupportedFITS(Exception):
+    pass
+
+
+def _value(raw):
+    raw = raw.split("/", 1)[0].strip()
+    if raw == "T":
+        return True
+    if raw == "F":
+        return False
+    try:
+        return int(raw)
+    except ValueError:
+        return float(raw.replace("D", "E"))
+
+
+def parse_header(raw):
+    """Numeric primary header cards and the offset of the data block."""
+    cards = {}
+    for start in range(0, len(raw), CARD):
+        card = raw[start:start + CARD].decode("ascii")
+        key = card[:8].rstrip()
+        if key == "END":
+            data_start = (start // BLOCK + 1) * BLOCK
+            return cards, data_start
+        if card[8:10] != "= " or card[10:].lstrip().startswith("'"):
+            continue # COMMENT/HISTORY/blank cards and string values
+        cards[key] = _value(card[10:])
+    raise UnsupportedFITS("no END card")
+
+
+def _read_fast(raw):
+    cards, data_start = parse_header(raw)
+
+    if cards.get("SIMPLE") is not True or cards.get("NAXIS") != 2:
+        raise UnsupportedFITS("not a simple 2d primary image")
+    if "BLANK" in cards:
+        raise UnsupportedFITS("BLANK values")
+    dtype = BITPIX_DTYPES.get(cards.get("BITPIX"))
+    if dtype is None:
+        raise UnsupportedFITS("unknown BITPIX")
+
+    shape = (cards["NAXIS2"], cards["NAXIS1"])
+    count = shape[0] * shape[1]
+    if len(raw) < data_start + count * np.dtype(dtype).itemsize:
+        raise UnsupportedFITS("truncated data")
+
+    data = np.frombuffer(raw, dtype = dtype, count = count, offset = data_start).reshape(shape)
+
+    bscale = cards.get("BSCALE", 1)
+    bzero = cards.get("BZERO", 0)
+    if bscale == 1 and bzero == 0:
+        return data
+    if bscale == 1 and bzero in UNSIGNED_BZERO:
+        raise UnsupportedFITS("unsigned integer convention")
+    out_dtype = np.float32 if cards["BITPIX"] in (8, 16, -32) else np.float64
+    return data * out_dtype(bscale) + out_dtype(bzero)
+
+
+def read_image(raw):
+    """Primary HDU data of an uncompressed FITS cutout.
+
+    Parses the header cards directly and maps the data block without a
+    copy, falling back to astropy for anything it doesn't recognise.
+    """
+    try:
+        return _read_fast(raw)
+    except (UnsupportedFITS, KeyError, ValueError, UnicodeDecodeError):
+        return fits.open(BytesIO(raw))[0].data
@@ -0,0 +1,302 @@
+"""The hostless scan: unclassified candidates that pass fixed quality and isolation cuts.
+
+The cuts that don't depend on the search fields are applied ahead of time
+into the hostless_eligible table (candid, epochid, abs_gallat, rbscore),
+indexed for the page's query, which then only filters on epoch and
+|gallat|. Each refresh records its epochs and when they were done in
+hostless_eligible_epochs; a scan of an epoch that isn't recorded there (or
+before either table exists) queries candidates directly. The server looks
+at the recorded epochs again every ELIGIBLE_CHECK_INTERVAL seconds, so a
+refresh is picked up without a restart.
+Create or update it after new candidates are loaded:
+
+    python -m utils.hostless --refresh            # every epoch
+    python -m utils.hostless --refresh --epoch 8  # only these epochs
+"""
+import os
+import argparse
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.exc import ProgrammingError
+
+from utils.classifications import TABLE as CLASSIFICATIONS
+from utils.classified_index import default_index
+from utils.queries import fetch
+from utils.db import make_engine
+
+# fixed cuts of the hostless scan, the page only sets the epoch, |gallat| range and candidate limit
+RBSCORE_LOW = 0.5
+RBSCORE_HIGH = 1.0
+NMATCHES = 2
+SCORR_PEAK = 10
+AGE_LOW = 10.0 # days since first detection
+AGE_HIGH = 400.0
+HOST_DIST = 3 # closest WISE source distance
+BRIGHT_MAG = 7.0 # reject if a WISE source is brighter than this
+BRIGHT_DIST = 10 # within this many arcseconds
+
+CUTS = (RBSCORE_LOW, RBSCORE_HIGH, NMATCHES, SCORR_PEAK, AGE_LOW, AGE_HIGH, HOST_DIST, BRIGHT_MAG, BRIGHT_DIST)
+
+ELIGIBLE_TABLE = "hostless_eligible"
+EPOCHS_TABLE = "hostless_eligible_epochs"
+ELIGIBLE_CHECK_INTERVAL = 60 # seconds, how long the list of refreshed epochs is trusted
+
+_eligible_epochs = (None, frozenset()) # (when it was read, epochs)
+_eligible_lock = threading.Lock()
+
+# scan results shared by every session, for this many seconds at most
+SCAN_CACHE_TTL = float(os.environ.get("NEOWISE_HOSTLESS_CACHE_TTL", 600))
+SCAN_CACHE_ENTRIES = 32
+SCAN_BATCH = 1000 # candids per keyset query when a scan is run
+
+_default = None
+_default_lock = threading.Lock()
+
+_CUTS = f"""
+    cand.rbscore >= {RBSCORE_LOW} AND cand.rbscore <= {RBSCORE_HIGH} AND cand.nmatches >= {NMATCHES}
+    AND cand.scorr_peak >= {SCORR_PEAK} AND cand.ispos = 1
+    AND cand.mjd - cand.firstdet > {AGE_LOW} AND cand.mjd - cand.firstdet < {AGE_HIGH}
+    AND cand.wdist1 > {HOST_DIST} AND cand.wdist2 > {HOST_DIST} AND cand.wdist3 > {HOST_DIST}
+    AND cand.distnearbrstar > {BRIGHT_DIST}
+    AND (cand.wdist1 > {BRIGHT_DIST} OR cand.w1mag1 > {BRIGHT_MAG})
+    AND (cand.wdist2 > {BRIGHT_DIST} OR cand.w1mag2 > {BRIGHT_MAG})
+    AND (cand.wdist3 > {BRIGHT_DIST} OR cand.w1mag3 > {BRIGHT_MAG})"""
+_ELIGIBLE_SELECT = f"""
+    SELECT cand.candid, cand.epochid, abs(f.gallat) AS abs_gallat, cand.rbscore
+    FROM candidates cand INNER JOIN fields f ON f.field = cand.field WHERE {_CUTS}"""
+_UNCLASSIFIED = f"NOT EXISTS (SELECT 1 FROM {CLASSIFICATIONS} c WHERE c.candid = cand.candid)"
+
+# (FROM clause, search predicates) with the table and without it; both alias the scanned rows as cand
+_SOURCES = {
+    True: (f"FROM {ELIGIBLE_TABLE} cand",
+           f"cand.epochid = :scanep AND cand.abs_gallat >= :gallimlow AND cand.abs_gallat < :gallimhigh AND {_UNCLASSIFIED}"),
+    False: ("FROM candidates cand INNER JOIN fields f ON f.field = cand.field",
+            f"cand.epochid = :scanep AND abs(f.gallat) >= :gallimlow AND abs(f.gallat) < :gallimhigh AND {_CUTS} AND {_UNCLASSIFIED}"),
+}
+# rbscore ties are broken by candid so every row has a unique place to resume from
+_ORDER = "ORDER BY cand.rbscore DESC, cand.candid DESC"
+# the key is read back from the candid's own row, so rbscore is compared in its column type rather than as a python float
+_AFTER = " AND (cand.rbscore, cand.candid) < (SELECT k.rbscore, k.candid FROM {table} k WHERE k.candid = :after)"
+
+CREATE_TABLE = f"""
+    CREATE TABLE IF NOT EXISTS {ELIGIBLE_TABLE} AS {_ELIGIBLE_SELECT} WITH NO DATA;
+    CREATE UNIQUE INDEX IF NOT EXISTS {ELIGIBLE_TABLE}_candid ON {ELIGIBLE_TABLE} (candid);
+    CREATE INDEX IF NOT EXISTS {ELIGIBLE_TABLE}_scan ON {ELIGIBLE_TABLE} (epochid, rbscore DESC, candid DESC);
+    CREATE INDEX IF NOT EXISTS {ELIGIBLE_TABLE}_gallat ON {ELIGIBLE_TABLE} (epochid, abs_gallat);
+    CREATE TABLE IF NOT EXISTS {EPOCHS_TABLE} (
+        epochid bigint PRIMARY KEY,
+        refreshed_at timestamptz NOT NULL DEFAULT now()
+    );"""
+_RECORD_EPOCH = text(f"""
+    INSERT INTO {EPOCHS_TABLE} (epochid) VALUES (:epoch)
+    ON CONFLICT (epochid) DO UPDATE SET refreshed_at = now();""")
+
+
+def hostless_params(scanep, gallimlow, gallimhigh):
+    """The page's search fields as query parameters, |gallat| bounds rounded to 0.01 degree like the cache key."""
+    return {"scanep": int(scanep), "gallimlow": round(float(gallimlow), 2), "gallimhigh": round(float(gallimhigh), 2)}
+
+
+def eligible_epochs(engine, force = False):
+    """Epochs that refresh() has written to hostless_eligible, read again once ELIGIBLE_CHECK_INTERVAL has passed."""
+    global _eligible_epochs
+    with _eligible_lock:
+        checked, epochs = _eligible_epochs
+        if force or checked is None or time.monotonic() - checked > ELIGIBLE_CHECK_INTERVAL:
+            try:
+                epochs = frozenset(int(e) for e in pd.read_sql_query(text(f"SELECT epochid FROM {EPOCHS_TABLE}"), engine).epochid)
+            except ProgrammingError: # never refreshed, see the module docstring
+                epochs = frozenset()
+            _eligible_epochs = (time.monotonic(), epochs)
+        return epochs
+
+
+def _read(engine, query, params, handle = None):
+    """Run query(eligible) on hostless_eligible if the scan's epoch has been refreshed into it, else on candidates.
+
+    Goes through utils.queries.fetch, so it has a statement timeout and
+    `handle` (a QueryHandle) can follow or cancel it.
+    """
+    eligible = params["scanep"] in eligible_epochs(engine)
+    try:
+        return fetch(engine, query(eligible), params, handle = handle)
+    except ProgrammingError:
+        if not eligible:
+            raise
+    eligible_epochs(engine, force = True) # the table went away since we last looked
+    return fetch(engine, query(False), params, handle = handle)
+
+
+def hostless_page(engine, params, per_page, after = None, handle = None):
+    """candids of one page of the hostless scan, highest rbscore first.
+
+    Candidates that have a label are left out by the query (an anti-join
+    on the unique candid index of the classifications table), so every
+    row returned is still to be reviewed. Pages are found by keyset
+    pagination on (rbscore, candid): `after` is the last candid of the
+    previous page, None for the first. Returns the page's candids and its
+    last candid (the next page's `after`).
+    """
+    def query(eligible):
+        source, where = _SOURCES[eligible]
+        if after is not None:
+            where += _AFTER.format(table = ELIGIBLE_TABLE if eligible else "candidates")
+        return f"SELECT cand.candid {source} WHERE {where} {_ORDER} LIMIT :n"
+    rows = _read(engine, query, {**params, "after": after, "n": int(per_page)}, handle)
+    last = int(rows.candid.iloc[-1]) if len(rows) else after
+    return rows.candid.to_numpy(), last
+
+
+def scan_key(params, limit):
+    """Cache key of a scan: the search fields as the query sees them, the limit and the fixed cuts."""
+    return (params["scanep"], params["gallimlow"], params["gallimhigh"], int(limit), CUTS)
+
+
+def scan(engine, params, limit, batch = SCAN_BATCH, handle = None):
+    """The first `limit` candids of the hostless scan, in page order, fetched `batch` at a time by keyset."""
+    candids, found, after = [], 0, None
+    while found < limit:
+        page, after = hostless_page(engine, params, min(batch, limit - found), after = after, handle = handle)
+        if len(page) == 0:
+            break
+        candids.append(page)
+        found += len(page)
+    return np.concatenate(candids) if candids else np.empty(0, dtype = np.int64)
+
+
+class ScanCache:
+    """Hostless scan results shared by every session of the server process.
+
+    Keyed by scan_key(), so reviewers running the same search share one
+    query; the first one runs it and the others wait for its result. An
+    entry is dropped once it is older than `ttl`, or when `classified` (a
+    ClassifiedIndex, optional) reports one of its candids as classified.
+    The least recently used entries go first beyond `max_entries`.
+    """
+
+    def __init__(self, ttl = SCAN_CACHE_TTL, max_entries = SCAN_CACHE_ENTRIES, classified = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.classified = classified
+        self._entries = OrderedDict() # key -> (time, candids)
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def _valid(self, entry):
+        when, candids = entry
+        if time.monotonic() - when > self.ttl:
+            return False
+        return self.classified is None or not self.classified.isin(candids).any()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if not self._valid(entry):
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, candids):
+        candids = np.asarray(candids, dtype = np.int64)
+        candids.setflags(write = False)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), candids)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last = False)
+        return candids
+
+    def load(self, engine, params, limit, run = None):
+        """The scan for `params` and `limit` (see scan()), from the cache when it is still valid.
+
+        `run(fn)` runs the scan as fn(handle), e.g. through
+        utils.queries.run_query; by default it is run directly. Waiting for
+        another session's scan of the same key happens in the calling
+        thread, so only a scan that actually runs goes through `run`.
+        """
+        key = scan_key(params, limit)
+        candids = self.get(key)
+        if candids is not None:
+            return candids
+        with self._lock:
+            running = self._running.setdefault(key, threading.Lock())
+        try:
+            with running:
+                candids = self.get(key) # somebody else may have run it while we waited
+                if candids is None:
+                    def fn(handle = None):
+                        return scan(engine, params, limit, handle = handle)
+                    candids = self.put(key, fn() if run is None else run(fn))
+        finally:
+            with self._lock:
+                self._running.pop(key, None)
+        return candids
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def default_cache(engine):
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = ScanCache(classified = default_index(engine))
+        return _default
+
+
+def refresh(engine, epochs = None):
+    """Recompute hostless_eligible for `epochs` (all when None), creating it first if needed.
+
+    Each epoch is swapped in its own transaction, so the page keeps
+    reading the old rows of an epoch until its new ones are committed, and
+    is recorded in hostless_eligible_epochs in that same transaction.
+    Returns the number of rows written.
+    """
+    with engine.begin() as con:
+        con.exec_driver_sql(CREATE_TABLE)
+        if epochs is None:
+            epochs = [int(e) for e in pd.read_sql_query(text("SELECT DISTINCT epochid FROM candidates ORDER BY epochid"), con).epochid]
+
+    written = 0
+    for epoch in epochs:
+        start = time.time()
+        with engine.begin() as con:
+            con.execute(text(f"DELETE FROM {ELIGIBLE_TABLE} WHERE epochid = :epoch"), {"epoch": int(epoch)})
+            n = con.execute(text(f"INSERT INTO {ELIGIBLE_TABLE} {_ELIGIBLE_SELECT} AND cand.epochid = :epoch"),
+                            {"epoch": int(epoch)}).rowcount
+            con.execute(_RECORD_EPOCH, {"epoch": int(epoch)})
+        written += n
+        print(f"epoch {epoch}: {n} eligible candidates, {time.time() - start:.1f}s", flush = True)
+    with engine.connect().execution_options(isolation_level = "AUTOCOMMIT") as con:
+        con.exec_driver_sql(f"ANALYZE {ELIGIBLE_TABLE}")
+    eligible_epochs(engine, force = True)
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Create or refresh the hostless_eligible table.")
+    parser.add_argument("--refresh", action = "store_true", help = "recompute the eligible candidates")
+    parser.add_argument("--epoch", type = int, nargs = "+", default = None, help = "only these epochs (default all)")
+    parser.add_argument("--print", action = "store_true", help = "print the table definition")
+    args = parser.parse_args()
+
+    if args.print:
+        print(CREATE_TABLE)
+    if args.refresh:
+        print(f"{refresh(make_engine(), args.epoch)} rows written.")
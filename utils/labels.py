@@ -0,0 +1,19 @@
+import pandas as pd
+from sqlalchemy import text, bindparam
+
+from utils.classifications import TABLE
+
+
+def locate_candidates(engine, candids):
+    """Labels of a list of candids, in one query on the classifications table.
+
+    Returns {candid: [label]} for the candids that are classified; a candid
+    has at most one label. Candids that aren't classified are left out.
+    """
+    candids = sorted(set(int(c) for c in candids))
+    if len(candids) == 0:
+        return {}
+    query = text(f"SELECT candid, label FROM {TABLE} WHERE candid IN :candids") \
+        .bindparams(bindparam("candids", expanding = True))
+    rows = pd.read_sql_query(query, engine, params = {"candids": candids})
+    return {int(candid): [label] for candid, label in zip(rows.candid.tolist(), rows.label.tolist())}
@@ -0,0 +1,137 @@
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+# rendered tiles are small and cheap to keep, a page of 50 triplets is a few MB at most
+PNG_CACHE_BYTES = int(float(os.environ.get("NEOWISE_PNG_CACHE_BYTES", 256e6)))
+# optional directory that keeps rendered pngs across restarts, off unless set
+PNG_CACHE_PATH = os.environ.get("NEOWISE_PNG_CACHE", "")
+PNG_CACHE_DISK_BYTES = int(float(os.environ.get("NEOWISE_PNG_CACHE_DISK_BYTES", 2e9)))
+
+_default = None
+_default_lock = threading.Lock()
+
+
+class PngCache:
+    """LRU of rendered png bytes with a byte budget, shared by every session.
+
+    Keys are small tuples such as (candid, band, vmin, vmax, width) so a
+    lookup never hashes image data. When `path` is set, entries that miss
+    in memory are looked for on disk and new ones are written there too;
+    the directory can be deleted at any time. The files are kept under
+    `max_disk_bytes`, the oldest written deleted first (files another
+    process writes to the same directory are only counted after a restart).
+    """
+
+    def __init__(self, max_bytes = PNG_CACHE_BYTES, path = None, max_disk_bytes = PNG_CACHE_DISK_BYTES):
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.path = path
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._files = OrderedDict() # file -> size, oldest first
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(path, exist_ok = True)
+            found = []
+            for entry in os.scandir(path):
+                try:
+                    if entry.name.endswith(".png"):
+                        stat = entry.stat()
+                        found.append((stat.st_mtime_ns, entry.path, stat.st_size))
+                except FileNotFoundError:
+                    pass
+            for _, file, size in sorted(found):
+                self._files[file] = size
+                self._disk_bytes += size
+            self._unlink(self._evict_files())
+
+    def _file(self, key):
+        return os.path.join(self.path, hashlib.sha1(repr(key).encode()).hexdigest() + ".png")
+
+    def _remember(self, key, png):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._entries[key] = png
+            self._bytes += len(png)
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                self._bytes -= len(self._entries.popitem(last = False)[1])
+
+    def get(self, key):
+        with self._lock:
+            png = self._entries.get(key)
+            if png is not None:
+                self._entries.move_to_end(key)
+                return png
+        if not self.path:
+            return None
+        try:
+            with open(self._file(key), "rb") as f:
+                png = f.read()
+        except FileNotFoundError:
+            return None
+        self._remember(key, png)
+        return png
+
+    def _evict_files(self):
+        # call with the lock held, or before the cache is shared; returns the files to delete
+        dropped = []
+        while self._disk_bytes > self.max_disk_bytes and len(self._files) > 1:
+            file, size = self._files.popitem(last = False)
+            self._disk_bytes -= size
+            dropped.append(file)
+        return dropped
+
+    @staticmethod
+    def _unlink(files):
+        for file in files:
+            try:
+                os.unlink(file)
+            except FileNotFoundError:
+                pass
+
+    def put(self, key, png):
+        self._remember(key, png)
+        if self.path:
+            file = self._file(key)
+            fd, tmp = tempfile.mkstemp(dir = self.path, suffix = ".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(png)
+            os.replace(tmp, file)
+            with self._lock:
+                self._disk_bytes += len(png) - self._files.pop(file, 0)
+                self._files[file] = len(png)
+                dropped = self._evict_files()
+            self._unlink(dropped)
+
+    def get_or_render(self, key, render):
+        """Cached png for `key`, calling render() to make it on a miss."""
+        png = self.get(key)
+        if png is None:
+            png = render()
+            self.put(key, png)
+        return png
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+    @property
+    def disk_nbytes(self):
+        return self._disk_bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def default_cache():
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = PngCache(PNG_CACHE_BYTES, PNG_CACHE_PATH or None)
+        return _default
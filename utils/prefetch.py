@@ -0,0 +1,107 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.cutouts import stream_candids
+
+PREFETCH_THREADS = int(os.environ.get("NEOWISE_PREFETCH_THREADS", 2))
+PREFETCH_BATCH = 25 # rows per fetch, cancellation is checked between batches
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers = PREFETCH_THREADS, thread_name_prefix = "prefetch")
+        return _executor
+
+
+def _default_store():
+    from utils.cutout_store import default_store
+    return default_store()
+
+
+def prefetch_candids(engine, candids, cancelled, store):
+    """Fetch the cutouts of `candids` that aren't in `store` yet and add them to it.
+
+    Stops between batches once `cancelled` is set. Returns how many cutouts
+    were added.
+    """
+    if cancelled.is_set():
+        return 0
+    candids = candids() if callable(candids) else candids
+    missing = store.get(candids)[1]
+    added = 0
+    batches = stream_candids(engine, missing.tolist(), batch = PREFETCH_BATCH, workers = 1)
+    try:
+        for batch in batches:
+            store.put(batch)
+            added += len(batch)
+            if cancelled.is_set():
+                break
+    finally:
+        batches.close() # releases the server side cursor if we stopped early
+    return added
+
+
+class Prefetcher:
+    """Loads the cutouts of pages the reviewer is likely to open next into the store.
+
+    One per session and page. Jobs are keyed by page number; each call to
+    prefetch() cancels the jobs for pages that are no longer wanted and
+    starts the rest again unless they are still running (a finished job
+    only costs a store lookup the second time). wait() lets the page that
+    is about to render reuse a job in flight instead of fetching the same
+    cutouts a second time, and drops the jobs it has no use for.
+    """
+
+    def __init__(self, engine, store = None):
+        self.engine = engine
+        self.store = _default_store() if store is None else store
+        self._jobs = {}
+
+    def prefetch(self, pages):
+        """`pages` maps page number -> its candids, or a callable returning them."""
+        if not self.store:
+            return
+        for key in list(self._jobs):
+            if key not in pages:
+                self.cancel(key)
+        for key, candids in pages.items():
+            if key in self._jobs and not self._jobs[key][0].done():
+                continue
+            cancelled = threading.Event()
+            future = _get_executor().submit(prefetch_candids, self.engine, candids, cancelled, self.store)
+            self._jobs[key] = (future, cancelled)
+
+    def wait(self, key):
+        """Block until the job for `key` (if any) has finished, ignoring its errors.
+
+        The jobs for every other page are cancelled first, the page being
+        rendered decides what to prefetch next. A job for `key` that hasn't
+        started yet (the pool is shared with the other sessions) is
+        cancelled too rather than waited for, the page then fetches its
+        cutouts itself.
+        """
+        for other in list(self._jobs):
+            if other != key:
+                self.cancel(other)
+        job = self._jobs.pop(key, None)
+        if job is None or job[0].cancel():
+            return
+        try:
+            job[0].result()
+        except Exception: # the page falls back to fetching the cutouts itself
+            pass
+
+    def cancel(self, key):
+        future, cancelled = self._jobs.pop(key)
+        cancelled.set()
+        future.cancel()
+
+    def cancel_all(self):
+        for key in list(self._jobs):
+            self.cancel(key)
@@ -0,0 +1,142 @@
+"""Long-running reads with a statement timeout, cancellation and progress.
+
+fetch() runs a query in its own transaction with SET LOCAL
+statement_timeout and streams the rows, keeping the backend pid and the
+row count on a QueryHandle so another thread can follow it or stop it
+with pg_cancel_backend. run_query() does that from a Streamlit page: the
+query runs in a worker thread while a spinner shows the elapsed time and
+rows fetched, a rerun that interrupts the page cancels it, and a new run
+for the same `key` cancels the one it supersedes if it is still going.
+"""
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import streamlit as st
+from sqlalchemy import text
+
+QUERY_TIMEOUT_MS = int(os.environ.get("NEOWISE_QUERY_TIMEOUT_MS", 120000))
+QUERY_BATCH = 5000 # rows per fetch, cancellation is checked between them
+QUERY_THREADS = 4
+SPINNER_REFRESH = 0.25 # seconds
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers = QUERY_THREADS, thread_name_prefix = "query")
+        return _executor
+
+
+class QueryCancelled(Exception):
+    pass
+
+
+class QueryHandle:
+    """The backend running a query and how far it got, shared with the thread that may cancel it."""
+
+    def __init__(self):
+        self.pid = None
+        self.rows = 0
+        self.started = time.monotonic()
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+        self._lock = threading.Lock() # held while the pid is being cancelled
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def cancel(self, engine):
+        """Stop the query: between batches, and on the server if a statement is running."""
+        self.cancelled.set()
+        with self._lock:
+            if self.pid is not None and not self.done.is_set():
+                cancel_backend(engine, self.pid)
+
+    def detach(self):
+        """Forget the backend before its connection goes back to the pool, after any cancel of it has finished."""
+        with self._lock:
+            self.pid = None
+
+
+def cancel_backend(engine, pid):
+    with engine.connect() as con:
+        return bool(con.execute(text("SELECT pg_cancel_backend(:pid)"), {"pid": int(pid)}).scalar())
+
+
+def set_timeout(con, timeout_ms):
+    """Statement timeout for the rest of the connection's current transaction (PostgreSQL only)."""
+    if timeout_ms and con.dialect.name == "postgresql":
+        con.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout_ms)}")
+
+
+def fetch(engine, query, params = None, timeout_ms = QUERY_TIMEOUT_MS, handle = None, batch = QUERY_BATCH):
+    """Rows of `query` as a DataFrame, fetched `batch` at a time through a server-side cursor.
+
+    Raises QueryCancelled once `handle` is cancelled, and the driver's
+    error when the server cancels the statement or it times out.
+    """
+    handle = QueryHandle() if handle is None else handle
+    query = text(query) if isinstance(query, str) else query
+    with engine.connect() as con:
+        try:
+            with con.begin():
+                if con.dialect.name == "postgresql":
+                    handle.pid = con.exec_driver_sql("SELECT pg_backend_pid()").scalar()
+                set_timeout(con, timeout_ms)
+                if handle.cancelled.is_set():
+                    raise QueryCancelled()
+                result = con.execution_options(stream_results = True, max_row_buffer = batch).execute(query, params or {})
+                columns = list(result.keys())
+                parts = []
+                for part in result.partitions(batch):
+                    parts.append(pd.DataFrame(part, columns = columns))
+                    handle.rows += len(part)
+                    if handle.cancelled.is_set():
+                        raise QueryCancelled()
+        finally: # before the connection goes back to the pool, where another query may get the same backend
+            handle.detach()
+    return pd.concat(parts, ignore_index = True) if parts else pd.DataFrame(columns = columns)
+
+
+def run_query(engine, label, fn, key = None):
+    """Call fn(handle) in a worker thread with a spinner showing the elapsed time and rows.
+
+    `fn` runs one or more fetch()es with the handle it is given. If the
+    page is interrupted (a rerun, the session closing) the handle is
+    cancelled; if `key` is given, a call from an earlier run of this
+    session with the same key that is still going is cancelled first.
+    """
+    handles = st.session_state.setdefault("_running_queries", {})
+    old = handles.get(key) if key is not None else None
+    if old is not None and not old.done.is_set():
+        old.cancel(engine)
+
+    handle = QueryHandle()
+    if key is not None:
+        handles[key] = handle
+
+    def run():
+        try:
+            return fn(handle)
+        finally:
+            handle.done.set()
+
+    future = _get_executor().submit(run)
+    try:
+        with st.spinner(label):
+            status = st.empty()
+            while not handle.done.wait(SPINNER_REFRESH):
+                status.caption(f"{label}: {handle.elapsed:.0f} s, {handle.rows} rows")
+            status.empty()
+    except BaseException: # the script was stopped while we waited
+        handle.cancel(engine)
+        raise
+    return future.result()
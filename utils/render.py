@@ -0,0 +1,124 @@
+import base64
+import hashlib
+from io import BytesIO
+
+import numpy as np
+import plotly.graph_objects as go
+import streamlit as st
+from PIL import Image
+
+from utils.cutouts import BANDS, to_uint8
+from utils.png_cache import default_cache
+
+TILE_PX = 280 # on-screen width of each sci/ref/diff panel, about what the old 10in figure gave
+
+# mosaic layout, in cutout pixels
+MOSAIC_COLS = 5 # triplets per row
+PANEL_GAP = 2 # between sci, ref and diff
+CELL_GAP = 8 # between triplets
+LABEL_PX = 14 # strip above each triplet for its label
+
+
+def upscale(tiles, px = TILE_PX):
+    """Nearest-neighbour enlarge (..., H, W) tiles to about px wide, so the browser doesn't blur them."""
+    factor = max(1, px // max(tiles.shape[-1], 1))
+    return tiles.repeat(factor, axis = -2).repeat(factor, axis = -1)
+
+
+def _png(image):
+    buf = BytesIO()
+    Image.fromarray(image).save(buf, format = "png")
+    return buf.getvalue()
+
+
+def triplet_pngs(candid, sci, ref, diff, vmin, vmax, cache = None):
+    """png bytes of the sci/ref/diff panels, from the png cache when they were rendered before.
+
+    Keyed on candid, band and stretch only, so a rerun costs three dict
+    lookups whatever the size of the images.
+    """
+    cache = default_cache() if cache is None else cache
+    images = (sci, ref, diff)
+    pngs = []
+    for band, name in enumerate(BANDS):
+        key = (int(candid), name, float(vmin[band]), float(vmax[band]), TILE_PX)
+        pngs.append(cache.get_or_render(key, lambda band = band: _png(upscale(to_uint8(images[band], vmin[band], vmax[band])))))
+    return pngs
+
+
+def render_triplet(candid, sci, ref, diff, vmin, vmax):
+    """Show one candidate's sci/ref/diff cutouts side by side, vmin/vmax are its (3,) stretch."""
+    st.markdown(f"**cand: {candid}**")
+    st.image(triplet_pngs(candid, sci, ref, diff, vmin, vmax), caption = list(BANDS))
+
+
+def _mosaic_layout(n, h, w, cols):
+    # rows of the grid and the (height, width) of a cell
+    return max(1, -(-n // cols)), LABEL_PX + h + CELL_GAP, 3 * w + 2 * PANEL_GAP + CELL_GAP
+
+
+def mosaic(images, vmin, vmax, cols = MOSAIC_COLS):
+    """A whole page of (N, 3, H, W) cutouts composed into one grey uint8 image.
+
+    Each triplet sits in its own cell, `cols` cells per row, with a blank
+    strip above it for a label. Returns the image and the (height, width)
+    of a cell.
+    """
+    tiles = to_uint8(images, vmin, vmax)
+    n, _, h, w = tiles.shape
+    rows, cell_h, cell_w = _mosaic_layout(n, h, w, cols)
+
+    cells = np.full((rows * cols, cell_h, cell_w), 255, dtype = np.uint8)
+    for band in range(3):
+        x = band * (w + PANEL_GAP)
+        cells[:n, LABEL_PX:LABEL_PX + h, x:x + w] = tiles[:, band]
+    image = cells.reshape(rows, cols, cell_h, cell_w).transpose(0, 2, 1, 3).reshape(rows * cell_h, cols * cell_w)
+    return image, (cell_h, cell_w)
+
+
+def _mosaic_uri(candids, images, vmin, vmax, cols):
+    # keyed like the single tiles: which candids, their stretch and the layout
+    digest = hashlib.sha1(b"".join(np.ascontiguousarray(a, dtype = dtype).tobytes()
+                                   for a, dtype in ((candids, np.int64), (vmin, np.float64), (vmax, np.float64)))).hexdigest()
+    png = default_cache().get_or_render(("mosaic", digest, images.shape[2:], cols),
+                                        lambda: _png(mosaic(images, vmin, vmax, cols)[0]))
+    return "data:image/png;base64," + base64.b64encode(png).decode()
+
+
+def render_mosaic(candids, images, vmin, vmax, labels = None, cols = MOSAIC_COLS, key = None):
+    """Show a page of cutouts as one mosaic image and return the rows the user picked.
+
+    The mosaic goes to the browser as a single png, cached like the single
+    tiles. Over every triplet sits
+    an invisible marker in row order, so clicking a triplet (or box/lasso
+    selecting several) reruns the page and returns their row indices into
+    `candids`, in order.
+    """
+    if len(candids) == 0:
+        return []
+    h, w = images.shape[2:]
+    rows, cell_h, cell_w = _mosaic_layout(len(candids), h, w, cols)
+    height, width = rows * cell_h, cols * cell_w
+    labels = [str(i) for i in range(len(candids))] if labels is None else labels
+
+    k = np.arange(len(candids))
+    x0 = (k % cols) * cell_w
+    y0 = (k // cols) * cell_h
+
+    fig = go.Figure(go.Image(source = _mosaic_uri(candids, images, vmin, vmax, cols)))
+    fig.add_trace(go.Scatter(
+        x = x0 + (3 * w + 2 * PANEL_GAP) / 2, y = y0 + LABEL_PX + h / 2, mode = "markers",
+        marker = dict(size = 40, opacity = 0),
+        hovertext = [f"{label}  cand: {candid}" for label, candid in zip(labels, candids)], hoverinfo = "text"))
+    for x, y, label, candid in zip(x0, y0, labels, candids):
+        fig.add_annotation(x = x, y = y + LABEL_PX / 2, text = f"{label}  {candid}", showarrow = False,
+                           xanchor = "left", font = dict(size = 10, color = "black"))
+    fig.update_xaxes(visible = False, range = [-0.5, width - 0.5])
+    fig.update_yaxes(visible = False, range = [height - 0.5, -0.5], scaleanchor = "x")
+    fig.update_layout(margin = dict(l = 0, r = 0, t = 0, b = 0), height = height * 1000 // width + 20,
+                      dragmode = "select", showlegend = False)
+
+    event = st.plotly_chart(fig, use_container_width = True, on_select = "rerun",
+                            selection_mode = ("points", "box", "lasso"), key = key)
+    # trace 1 is the markers, their point index is the row
+    return sorted({point["point_index"] for point in event.selection.points if point.get("curve_number") == 1})
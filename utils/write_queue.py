@@ -0,0 +1,189 @@
+import os
+import time
+import queue
+import threading
+
+import streamlit as st
+from sqlalchemy.exc import DBAPIError, OperationalError
+
+from utils.classifications import classify_statement, unclassify_statement
+from utils.classified_index import default_index
+
+WRITE_BATCH = 200 # writes per transaction at most
+WRITE_RETRIES = int(os.environ.get("NEOWISE_WRITE_RETRIES", 5))
+WRITE_RETRY_DELAY = 0.5 # seconds before the first retry, doubled after each one
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def _runs(ops):
+    """Split ops into runs of consecutive writes with the same statement, keeping their order."""
+    runs = []
+    for statement, params, _ in ops:
+        if runs and runs[-1][0] is statement:
+            runs[-1][1].append(params)
+        else:
+            runs.append((statement, [params]))
+    return runs
+
+
+class WriteQueue:
+    """Classification writes applied in the background, so a click doesn't wait for the database.
+
+    One per server process. classify() and unclassify() only put the
+    write on a queue; a worker thread takes everything queued so far (up
+    to `batch`) and applies it in one transaction, with consecutive writes
+    of the same kind sent as a single executemany. Writes are applied in
+    the order they were queued. A transaction is retried with a growing
+    delay only when the connection was the problem (connecting failed or
+    the connection was invalidated); any other error, or running out of
+    `retries`, has its writes tried one at a time and the ones that still
+    fail are kept in failed(). Applied writes are passed on to `index` (a
+    ClassifiedIndex, optional) before they stop counting as queued, so a
+    candid classified here is always either queued or in the index.
+    """
+
+    def __init__(self, engine, batch = WRITE_BATCH, retries = WRITE_RETRIES, delay = WRITE_RETRY_DELAY, index = None):
+        self.engine = engine
+        self.index = index
+        self.batch = batch
+        self.retries = retries
+        self.delay = delay
+        self._queue = queue.Queue()
+        self._pending = {} # candid -> (label or None, queued writes for it)
+        self._failed = []
+        self._written = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._thread = None
+
+    def classify(self, candid, label, replace = True):
+        """Queue classify(engine, candid, label, replace); raises ValueError for an unknown label right away."""
+        statement, params = classify_statement(candid, label, replace)
+        self._put(statement, params, label)
+
+    def unclassify(self, candid, label = None):
+        statement, params = unclassify_statement(candid, label)
+        self._put(statement, params, None)
+
+    def _put(self, statement, params, label):
+        candid = params["candid"]
+        with self._lock:
+            count = self._pending.get(candid, (None, 0))[1]
+            self._pending[candid] = (label, count + 1)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target = self._run, name = "write-queue", daemon = True)
+                self._thread.start()
+        self._queue.put((statement, params, label))
+
+    def _run(self):
+        while True:
+            ops = [self._queue.get()]
+            while len(ops) < self.batch:
+                try:
+                    ops.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            failed = len(self._failed)
+            self._write(ops)
+            with self._lock:
+                for _, params, _ in ops:
+                    label, count = self._pending[params["candid"]]
+                    if count == 1:
+                        del self._pending[params["candid"]]
+                    else:
+                        self._pending[params["candid"]] = (label, count - 1)
+                self._written += len(ops) - (len(self._failed) - failed)
+                self._idle.notify_all()
+
+    def _execute(self, con, ops):
+        with con.begin():
+            for statement, params in _runs(ops):
+                con.execute(statement, params)
+
+    def _applied(self, ops):
+        if self.index is None:
+            return
+        labels = {} # the last write of each candid decides
+        for _, params, label in ops:
+            labels[params["candid"]] = label
+        self.index.update(added = [c for c, label in labels.items() if label is not None],
+                          removed = [c for c, label in labels.items() if label is None])
+
+    def _write(self, ops):
+        delay = self.delay
+        for attempt in range(self.retries + 1):
+            unreachable = False
+            try:
+                con = self.engine.connect()
+            except OperationalError as e: # the server is unreachable, try again later
+                error, unreachable = e, True
+            else:
+                try:
+                    with con:
+                        self._execute(con, ops)
+                    self._applied(ops)
+                    return
+                except DBAPIError as e:
+                    error, unreachable = e, e.connection_invalidated
+                    if not unreachable:
+                        break # the connection is fine, a write is not: apply them one at a time below
+                except Exception as e:
+                    error = e
+                    break
+            if attempt < self.retries:
+                time.sleep(delay)
+                delay *= 2
+        if len(ops) == 1 or unreachable: # one at a time would only wait out the same retries again
+            with self._lock:
+                self._failed.extend((params["candid"], label, repr(error)) for _, params, label in ops)
+            return
+        for op in ops:
+            self._write([op])
+
+    @property
+    def pending(self):
+        """Writes queued or in flight."""
+        with self._lock:
+            return sum(count for _, count in self._pending.values())
+
+    def queued(self, candids):
+        """{candid: label} for the candids in `candids` with a write still pending; None means unclassified."""
+        with self._lock:
+            return {int(c): self._pending[int(c)][0] for c in candids if int(c) in self._pending}
+
+    def failed(self):
+        """(candid, label, error) of the writes that could not be applied."""
+        with self._lock:
+            return list(self._failed)
+
+    def flush(self, timeout = None):
+        """Wait until every queued write has been applied or given up on; False on timeout."""
+        with self._lock:
+            return self._idle.wait_for(lambda: not self._pending, timeout)
+
+    def stats(self):
+        with self._lock:
+            return {"pending": sum(count for _, count in self._pending.values()), "written": self._written,
+                    "failed": len(self._failed)}
+
+
+def default_queue(engine):
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = WriteQueue(engine, index = default_index(engine))
+        return _default
+
+
+@st.fragment(run_every = 2)
+def pending_indicator(write_queue):
+    """Sidebar line with the writes still on their way to the database, refreshed every 2 s."""
+    stats = write_queue.stats()
+    if stats["pending"]:
+        st.caption(f"⏳ {stats['pending']} classification(s) waiting to be saved")
+    else:
+        st.caption("✅ All classifications saved")
+    for candid, label, error in write_queue.failed()[-5:]:
+        st.error(f"Could not save {candid} as {label}: {error}")